@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+"""Benchmarks for the hot paths of the wikimeta plugin.
+
+Builds a throwaway Trac environment on an in-memory SQLite database with
+TracTags and the wikimeta plugin enabled, fills it with synthetic pages, tags,
+categories and wikimeta history at several scales, and times the request
+handlers. Each result is printed as one JSON object per line, so runs before
+and after a change can be compared with any line-oriented tool:
+
+    python benchmarks/bench_wikimeta.py --scales 100,1000 --repeat 5 > before.jsonl
+
+Requires Trac, Genshi and TracTags to be installed, like the plugin itself.
+"""
+
+import gc
+import json
+import optparse
+import random
+import sys
+import time
+
+from genshi.input import HTML
+
+from trac.mimeview import Context
+from trac.test import EnvironmentStub, Mock, MockPerm
+from trac.util.datefmt import to_datetime, to_utimestamp, utc
+from trac.web.api import RequestDone
+from trac.web.href import Href
+
+import tractags.api
+import tractags.model
+import tractags.wiki
+
+from wikimeta.search import reindex_all
+from wikimeta.wikimeta import PRIORITY_GAP, STATES, WikiMetaPlugin
+
+TAGS = ['team%d' % i for i in range(8)] + ['sprint%d' % i for i in range(12)] + \
+       ['bug', 'feature', 'research', 'docs']
+CATEGORIES = {'teams': TAGS[:8], 'sprints': TAGS[8:20]}
+USERS = ['user%d' % i for i in range(50)]
+
+WIKI_EDIT = HTML("""<html><body><form id="edit" method="post">
+  <div id="changeinfo1"><input type="text" name="comment"/></div>
+  <div id="changeinfo2"><input type="submit" name="save"/></div>
+</form></body></html>""")
+
+# Typical Trac pages the stream filter sees besides the wiki editor: a
+# repeated block of the usual markup, with links, images and tables.
+_BLOCK = """<div class="item"><h2><a href="/trac/ticket/%(n)d">#%(n)d</a></h2>
+  <img src="/trac/chrome/common/ticket.png" alt="ticket"/>
+  <table class="properties"><tr><th>Owner:</th><td>user%(n)d</td></tr>
+  <tr><th>Status:</th><td>new</td></tr></table>
+  <p>Some <em>text</em> with a <a href="/trac/wiki/Page%(n)d">link</a>.</p></div>"""
+TEMPLATE_MIX = [(name, HTML('<html><body><div id="content">%s</div></body></html>'
+                             % ''.join(_BLOCK % {'n': n} for n in range(blocks))))
+                for name, blocks in [('timeline.html', 200), ('ticket.html', 20),
+                                     ('changeset.html', 100), ('wiki_view.html', 10)]]
+
+
+def create_env(scale, seed=0):
+    """Return a fresh environment with `scale` pages of synthetic data."""
+    env = EnvironmentStub(default_data=True,
+                          enable=['trac.*', 'tractags.*', 'wikimeta.*'])
+    # the wikimeta setup waits for the TracTags tables, so two passes are
+    # needed; env.upgrade() would drop the in-memory database after the
+    # first, as it shuts down the connection pool
+    with env.db_transaction as db:
+        for attempt in range(2):
+            for participant in env.setup_participants:
+                if participant.environment_needs_upgrade(db):
+                    participant.upgrade_environment(db)
+
+    rnd = random.Random(seed)
+    now = time.time()
+    db = env.get_db_cnx()
+    cursor = db.cursor()
+    pages, tags, history, current = [], [], [], []
+    for index in range(scale):
+        name = 'BenchPage%05d' % index
+        modified = now - rnd.randint(0, 365 * 86400)
+        text = '= %s =\n%s\n * [wiki:BenchPage%05d]\n' % (
+            name, ' '.join(rnd.choice(TAGS) for i in range(200)),
+            rnd.randrange(scale))
+        pages.append((name, 1, to_utimestamp(to_datetime(modified, utc)),
+                      'bench', '127.0.0.1', text, '', 0))
+        for tag in rnd.sample(TAGS, 3):
+            tags.append(('wiki', name, tag))
+        # a few state changes per page, the last one is current
+        t = modified - 30 * 86400
+        for change in range(rnd.randint(1, 6)):
+            state = rnd.choice(STATES)
+            owner = rnd.choice(USERS)
+            history.append([name, owner, state, 0, t + change * 86400, 'bench', 0])
+        history[-1][6] = 1
+        row = history[-1]
+        if row[2] == 'planned':
+            row[3] = (scale - index) * PRIORITY_GAP
+        current.append(tuple(row[:6]))
+    cursor.executemany("""
+        INSERT INTO wiki (name, version, time, author, ipnr, text, comment, readonly)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        """, pages)
+    cursor.executemany("""
+        INSERT INTO tags (tagspace, name, tag) VALUES (%s, %s, %s)
+        """, tags)
+    cursor.executemany("""
+        INSERT INTO tags_category (category, tag) VALUES (%s, %s)
+        """, [(category, tag) for category, category_tags in CATEGORIES.items()
+              for tag in category_tags])
+    cursor.executemany("""
+        INSERT INTO wikimeta (name, owner, state, priority, time, author, current)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        """, [tuple(row) for row in history])
+    cursor.executemany("""
+        INSERT INTO wikimeta_current (name, owner, state, priority, time, author)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        """, current)
+    cursor.executemany("""
+        INSERT INTO session (sid, authenticated, last_visit) VALUES (%s, 1, 0)
+        """, [(user,) for user in USERS])
+    reindex_all(cursor)
+    db.commit()
+    return env
+
+
+def make_request(env, path_info='/wikimeta', args=None, method='GET'):
+    """Return a request object good enough for the plugin's handlers."""
+    args = dict(args or {})
+    headers = []
+
+    def send(content, content_type='text/html', status=200):
+        raise RequestDone
+
+    req = Mock(path_info=path_info, method=method, args=args,
+               authname='admin', remote_addr='127.0.0.1', remote_user='admin',
+               perm=MockPerm(), session={}, locale=None, tz=utc,
+               href=Href('/trac'), abs_href=Href('http://example.org/trac'),
+               base_path='/trac', chrome={}, query_string='',
+               get_header=lambda name: None, outheaders=headers,
+               send_header=lambda name, value: headers.append((name, value)),
+               send_response=lambda code=200: None, end_headers=lambda: None,
+               write=lambda data: None, send=send,
+               redirect=lambda url, permanent=False: send(url))
+    return req
+
+
+def reset_caches(env):
+    plugin = WikiMetaPlugin(env)
+    plugin._clear_caches()
+    plugin._facet_cache.clear()
+    plugin._macro_cache.clear()
+
+
+def timed(func, repeat, setup=None):
+    """Return the run times of `func` in seconds."""
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        try:
+            func()
+        except RequestDone:
+            pass
+        times.append(time.time() - start)
+    return times
+
+
+def run(scales, repeat, out):
+    for scale in scales:
+        env = create_env(scale)
+        plugin = WikiMetaPlugin(env)
+
+        def report(name, times, **params):
+            times = sorted(times)
+            record = {'benchmark': name, 'scale': scale, 'runs': len(times),
+                      'min': times[0], 'median': times[len(times) // 2],
+                      'mean': sum(times) / len(times)}
+            record.update(params)
+            out.write(json.dumps(record, sort_keys=True) + '\n')
+            out.flush()
+
+        filters = [
+            ('all', {}),
+            ('planned', {'state_name': 'planned'}),
+            ('owner', {'owner_name': USERS[0]}),
+            ('one_tag', {'tagfilter_team1': 'on'}),
+            ('two_tags', {'state_name': 'planned', 'tagfilter_team1': 'on',
+                          'tagfilter_bug': 'on'}),
+            ('text', {'q': 'team1 spr'}),
+        ]
+        for label, args in filters:
+            view = lambda: plugin.process_request(make_request(env, args=args))
+            report('process_request', timed(view, repeat, lambda: reset_caches(env)),
+                   filter=label, cache='cold')
+            report('process_request', timed(view, repeat), filter=label, cache='warm')
+
+        def wiki_data():
+            req = make_request(env)
+            context = Context.from_request(req, 'wiki')
+            rows, next_cursor = plugin._get_wiki_data(context, 'planned', 'all', [],
+                                                      None, plugin.page_size)
+            return list(rows)
+        report('_get_wiki_data', timed(wiki_data, repeat, lambda: reset_caches(env)),
+               cache='cold')
+
+        # memory held by the results, and the container objects allocated
+        # per call with warm caches; the rows of the previous scale are freed
+        # first, so that freeing them is not counted against this call:
+        rows = None
+        wiki_data()
+        gc.collect()
+        gc.disable()
+        try:
+            before = len(gc.get_objects())
+            rows = wiki_data()
+            allocated = len(gc.get_objects()) - before
+        finally:
+            gc.enable()
+        size = sum(sys.getsizeof(row) for row in rows)
+        out.write(json.dumps({'benchmark': '_get_wiki_data.memory', 'scale': scale,
+                              'results': len(rows), 'gc_objects': allocated,
+                              'result_bytes': size}, sort_keys=True) + '\n')
+
+        cursor = env.get_db_cnx().cursor()
+        cursor.execute("""
+            SELECT name FROM wikimeta_current WHERE state='planned'
+             ORDER BY priority DESC
+            """)
+        planned = [row[0] for row in cursor]
+        if len(planned) > 2:
+            def reorder():
+                name = random.choice(planned[1:])
+                plugin._priority_reorder(name, planned[0], True)
+            report('_priority_reorder', timed(reorder, repeat))
+
+        def save():
+            name = 'BenchPage%05d' % random.randrange(scale)
+            req = make_request(env, '/wiki/%s' % name, method='POST', args={
+                'save': 'Submit changes', 'page': name,
+                'state_name': random.choice(STATES),
+                'owner_name': random.choice(USERS)})
+            plugin.pre_process_request(req, None)
+        report('PageMeta.save', timed(save, repeat))
+
+        def edit_form():
+            req = make_request(env, '/wiki/BenchPage00000', args={
+                'page': 'BenchPage00000', 'action': 'edit'})
+            stream = plugin.filter_stream(req, 'GET', 'wiki_edit.html',
+                                          WIKI_EDIT, {})
+            stream.render('xhtml')
+        report('filter_stream', timed(edit_form, repeat), template='wiki_edit.html')
+
+        # the cost of the stream filter on other pages, against rendering
+        # the same page without it:
+        for template, page in TEMPLATE_MIX:
+            req = make_request(env, '/' + template.split('.')[0])
+            unfiltered = lambda: page.render('xhtml')
+            filtered = lambda: plugin.filter_stream(req, 'GET', template, page,
+                                                    {}).render('xhtml')
+            report('render', timed(unfiltered, repeat), template=template)
+            report('filter_stream', timed(filtered, repeat), template=template)
+
+        env.reset_db()
+        env.shutdown()
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--scales', default='100,1000,10000',
+                      help='comma separated numbers of pages [%default]')
+    parser.add_option('--repeat', type='int', default=5,
+                      help='runs per benchmark [%default]')
+    parser.add_option('--output', default=None,
+                      help='write the JSON lines to this file')
+    options, args = parser.parse_args(argv)
+    scales = [int(scale) for scale in options.scales.split(',')]
+    out = sys.stdout
+    if options.output:
+        out = open(options.output, 'w')
+    try:
+        run(scales, options.repeat, out)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -11,7 +11,8 @@ setup(
         wikimeta = wikimeta
     """,
     package_data={'wikimeta': ['templates/*.html', 
-                                 'htdocs/css/*.css', 
+                                 'htdocs/css/*.css',
+                                 'htdocs/js/*.js', 
                                  'htdocs/images/*']},
 )
 
@@ -1,2 +1,3 @@
 # Wikimeta module
 from wikimeta import *
+from admin import *
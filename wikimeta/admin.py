@@ -0,0 +1,263 @@
+# Wikimeta administration
+
+import threading
+import time
+
+from trac.admin import IAdminCommandProvider, IAdminPanelProvider
+from trac.config import IntOption
+from trac.core import *
+from trac.db.api import DatabaseManager
+from trac.util.text import printout
+from trac.web.api import IRequestFilter
+
+from wikimeta import HISTORY_SQL, WikiMetaPlugin, _read_import_csv
+from search import reindex_all
+from report import rebuild_rollups
+
+
+class WikiMetaAdmin(Component):
+    """trac-admin commands and scheduled maintenance for the wikimeta
+    tables."""
+    implements(IAdminCommandProvider, IAdminPanelProvider, IRequestFilter)
+
+    compact_interval = IntOption('wikimeta', 'compact_interval', 0,
+        """Compact the wikimeta history every that many days, from a
+        background thread started by the next request (0 disables it).""")
+
+    archive_age = IntOption('wikimeta', 'archive_age', 365,
+        """Age in days after which `wikimeta compact` moves non-current
+        history rows to the wikimeta_archive table.""")
+
+    def __init__(self):
+        self._next_compaction = None
+
+    # IAdminCommandProvider methods
+    def get_admin_commands(self):
+        yield ('wikimeta compact', '[age]',
+               """Compact the wikimeta history
+
+               Removes history rows that repeat the owner and state of the
+               previous row of the same page, moves non-current rows older
+               than `age` days (default: [wikimeta] archive_age) to the
+               wikimeta_archive table, and reclaims the freed space.""",
+               None, self._do_compact)
+        yield ('wikimeta import', '<csvfile> [author]',
+               """Create or update wiki pages with their meta data from a CSV file
+
+               The first line of the UTF-8 file names the columns, any of
+               name, owner, state, priority, tags and text. Pages without
+               a name get an unused name made of their tags; the text is
+               only used for pages that do not exist yet.""",
+               None, self._do_import)
+        yield ('wikimeta reindex', '',
+               """Rebuild the word index of the WikiFilter text filter
+
+               Only needed after wiki pages were changed without going
+               through Trac, e.g. by editing the database directly.""",
+               None, self._do_reindex)
+        yield ('wikimeta rollup', '',
+               """Recompute the daily state transition rollups
+
+               Rebuilds the numbers shown by the WikiFilter report from the
+               full wikimeta history, including archived rows.""",
+               None, self._do_rollup)
+        yield ('wikimeta category list', '',
+               'Show the tag categories of the WikiFilter sidebar',
+               None, self._do_category_list)
+        yield ('wikimeta category add', '<category> <tag>',
+               'Add a tag to a category of the WikiFilter sidebar',
+               None, self._do_category_add)
+        yield ('wikimeta category remove', '<category> <tag>',
+               'Remove a tag from a category of the WikiFilter sidebar',
+               None, self._do_category_remove)
+
+    def _do_compact(self, age=None):
+        if age is None:
+            age = self.archive_age
+        collapsed, archived = self.compact(int(age))
+        printout('Removed %d repeated and archived %d old history rows.'
+                 % (collapsed, archived))
+
+    def _do_import(self, filename, author='trac'):
+        fileobj = open(filename, 'rb')
+        try:
+            records = _read_import_csv(fileobj)
+        finally:
+            fileobj.close()
+        imported, created = WikiMetaPlugin(self.env)._import_pages(records, author)
+        printout('Imported %d pages, %d of them new.' % (imported, created))
+
+    def _do_reindex(self):
+        db = self.env.get_db_cnx()
+        count = reindex_all(db.cursor())
+        db.commit()
+        printout('Indexed the words of %d wiki pages.' % count)
+
+    def _do_rollup(self):
+        db = self.env.get_db_cnx()
+        rebuild_rollups(db.cursor(), HISTORY_SQL)
+        db.commit()
+        printout('Recomputed the state transition rollups.')
+
+    def _do_category_list(self):
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("""
+            SELECT category, tag FROM tags_category ORDER BY category, tag
+            """)
+        for category, tag in cursor:
+            printout('%s: %s' % (category, tag))
+
+    def _do_category_add(self, category, tag):
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("""
+            DELETE FROM tags_category WHERE category=%s AND tag=%s
+            """, (category, tag))
+        cursor.execute("""
+            INSERT INTO tags_category (category, tag) VALUES (%s, %s)
+            """, (category, tag))
+        db.commit()
+        WikiMetaPlugin(self.env)._tags_changed()
+
+    def _do_category_remove(self, category, tag):
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("""
+            DELETE FROM tags_category WHERE category=%s AND tag=%s
+            """, (category, tag))
+        db.commit()
+        WikiMetaPlugin(self.env)._tags_changed()
+
+    # IAdminPanelProvider methods
+    def get_admin_panels(self, req):
+        if 'TRAC_ADMIN' in req.perm:
+            yield ('wikimeta', 'WikiMeta', 'profile', 'Profiling')
+
+    def render_admin_panel(self, req, cat, page, path_info):
+        req.perm.require('TRAC_ADMIN')
+        stats = WikiMetaPlugin(self.env)._request_stats
+        points = (50, 90, 99)
+        data = {'points': points, 'window': stats.size,
+                'percentiles': stats.percentiles(points)}
+        return 'wikimeta_admin_profile.html', data
+
+    # IRequestFilter methods
+    def pre_process_request(self, req, handler):
+        if self.compact_interval > 0 and self._compaction_due():
+            thread = threading.Thread(target=self.compact,
+                                      name='wikimeta-compact')
+            thread.setDaemon(True)
+            thread.start()
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return (template, data, content_type)
+
+    # internal methods
+    def _compaction_due(self):
+        """Return True if this process should run the scheduled compaction
+        now. The last run is recorded in the system table, so only one
+        process wins when several see the compaction as due."""
+        now = int(time.time())
+        if self._next_compaction is not None and now < self._next_compaction:
+            return False
+        interval = self.compact_interval * 86400
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("""
+            SELECT value FROM system WHERE name='wikimeta_last_compaction'
+            """)
+        row = cursor.fetchone()
+        if row is None:
+            cursor.execute("""
+                INSERT INTO system (name, value)
+                VALUES ('wikimeta_last_compaction', %s)
+                """, (str(now),))
+            db.commit()
+            self._next_compaction = now + interval
+            return False
+        last = int(row[0])
+        if now < last + interval:
+            self._next_compaction = last + interval
+            return False
+        cursor.execute("""
+            UPDATE system SET value=%s
+            WHERE name='wikimeta_last_compaction' AND value=%s
+            """, (str(now), row[0]))
+        won = cursor.rowcount == 1
+        db.commit()
+        self._next_compaction = now + interval
+        return won
+
+    def compact(self, age=None):
+        """Collapse repeated history rows and archive old ones.
+
+        Returns a `(collapsed, archived)` tuple with the number of rows
+        removed and moved to wikimeta_archive.
+        """
+        if age is None:
+            age = self.archive_age
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+
+        # the last archived state of each page starts its run in wikimeta
+        cursor.execute("""
+            SELECT a.name, a.owner, a.state FROM wikimeta_archive a
+             WHERE a.time=(SELECT max(b.time) FROM wikimeta_archive b
+                            WHERE b.name=a.name)
+            """)
+        previous = dict((row[0], (row[1], row[2])) for row in cursor)
+
+        # a row repeating the owner and state of the row before it is not a
+        # transition; keep the first row of each run and the current row
+        cursor.execute("""
+            SELECT name, owner, state, time, current FROM wikimeta
+             ORDER BY name, time
+            """)
+        repeated = []
+        for name, owner, state, t, current in cursor:
+            if previous.get(name) == (owner, state) and not current:
+                repeated.append((name, owner, state, t))
+            else:
+                previous[name] = (owner, state)
+        cursor.executemany("""
+            DELETE FROM wikimeta
+             WHERE name=%s AND owner=%s AND state=%s AND time=%s AND current=0
+            """, repeated)
+
+        cutoff = time.time() - age * 86400
+        cursor.execute("""
+            SELECT count(*) FROM wikimeta WHERE current=0 AND time<%s
+            """, (cutoff,))
+        archived = cursor.fetchone()[0]
+        cursor.execute("""
+            INSERT INTO wikimeta_archive
+                   (name, owner, state, priority, time, author, current)
+            SELECT name, owner, state, priority, time, author, current
+              FROM wikimeta WHERE current=0 AND time<%s
+            """, (cutoff,))
+        cursor.execute("""
+            DELETE FROM wikimeta WHERE current=0 AND time<%s
+            """, (cutoff,))
+        db.commit()
+        self.log.info("compacted wikimeta history: %d repeated rows removed, "
+                      "%d rows archived" % (len(repeated), archived))
+
+        self._vacuum(db)
+        return len(repeated), archived
+
+    def _vacuum(self, db):
+        """Reclaim the space of the removed rows, where the backend allows
+        it outside of a transaction."""
+        dburi = DatabaseManager(self.env).connection_uri
+        cursor = db.cursor()
+        if dburi.startswith('sqlite:'):
+            cursor.execute("VACUUM")
+        elif dburi.startswith('mysql:'):
+            cursor.execute("OPTIMIZE TABLE wikimeta")
+        elif dburi.startswith('postgres:'):
+            # VACUUM cannot run in a transaction block; refresh the planner
+            # statistics and leave the space to autovacuum
+            cursor.execute("ANALYZE wikimeta")
+            db.commit()
@@ -0,0 +1,196 @@
+# Wikimeta in-process caches
+
+import threading
+import time
+
+from bisect import bisect_left
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Size-bounded mapping that evicts the least recently used entry.
+
+    Keys of the rendered-HTML cache are tuples starting with the page name,
+    so all entries of a page can be dropped with `invalidate(page_name)`.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            if key not in self._data:
+                return default
+            value = self._data.pop(key)
+            self._data[key] = value
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        if self.size <= 0:
+            return
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def invalidate(self, name):
+        """Drop all entries whose key starts with `name`."""
+        self._lock.acquire()
+        try:
+            for key in [k for k in self._data if k[0] == name]:
+                del self._data[key]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data.clear()
+        finally:
+            self._lock.release()
+
+
+class TagIndex(object):
+    """Index from the names of current wikimeta pages to their tags.
+
+    The index is loaded with a single query and then kept up to date page by
+    page: `invalidate(name)` marks a page as dirty, and all dirty pages are
+    re-read in one query the next time the index is used. Tags changed
+    without this plugin are picked up when the index is reloaded after the
+    `ttl` given to `sync()`.
+    """
+    def __init__(self):
+        self._tags = None   # page name -> set of tags
+        self._expiry = None
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def _read(self, db, names=None, batch_size=500):
+        cursor = db.cursor()
+        sql = """
+            SELECT t.name, t.tag FROM tags t
+              INNER JOIN wikimeta_current m ON m.name=t.name
+             WHERE t.tagspace='wiki'"""
+        rows = []
+        if names is None:
+            cursor.execute(sql)
+            rows = cursor.fetchall()
+        else:
+            sql += " AND t.name IN (%s)"
+            for start in range(0, len(names), batch_size):
+                batch = names[start:start + batch_size]
+                cursor.execute(sql % ','.join(['%s'] * len(batch)), batch)
+                rows.extend(cursor.fetchall())
+        tags = {}
+        for name, tag in rows:
+            tags.setdefault(name, set()).add(tag)
+        return tags
+
+    def sync(self, db, ttl=None):
+        """Load the index if it is not loaded or older than `ttl` seconds,
+        or refresh the pages invalidated since last use."""
+        self._lock.acquire()
+        try:
+            now = time.time()
+            if self._tags is None or (self._expiry is not None and now >= self._expiry):
+                self._dirty.clear()
+                self._tags = self._read(db)
+                self._expiry = ttl is not None and now + ttl or None
+            elif self._dirty:
+                names = list(self._dirty)
+                self._dirty.clear()
+                tags = self._read(db, names)
+                for name in names:
+                    if name in tags:
+                        self._tags[name] = tags[name]
+                    else:
+                        self._tags.pop(name, None)
+        finally:
+            self._lock.release()
+
+    def invalidate(self, name):
+        self._lock.acquire()
+        try:
+            self._dirty.add(name)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._tags = None
+        finally:
+            self._lock.release()
+
+    def tags_of(self, name):
+        """Return the sorted tags of a page."""
+        tags = self._tags
+        if tags is None:
+            # cleared by another thread since the last sync
+            return []
+        return sorted(tags.get(name, ()))
+
+
+class PrefixIndex(object):
+    """Sorted, case-insensitive prefix index over a list of strings."""
+    def __init__(self, values):
+        pairs = sorted((value.lower(), value) for value in values)
+        self._keys = [key for key, value in pairs]
+        self._values = [value for key, value in pairs]
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def complete(self, prefix, limit=None):
+        """Return the values starting with `prefix`, in sorted order."""
+        prefix = (prefix or '').lower()
+        start = bisect_left(self._keys, prefix)
+        end = bisect_left(self._keys, prefix + u'\uffff', start)
+        if limit is not None:
+            end = min(end, start + limit)
+        return self._values[start:end]
+
+
+class HitCounter(object):
+    """Request counts of the most frequently seen keys.
+
+    At most `size` keys are counted; when more are seen, only the more
+    frequent half of them is kept.
+    """
+    def __init__(self, size=1000):
+        self.size = size
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def hit(self, key, count=1):
+        self._lock.acquire()
+        try:
+            self._counts[key] = self._counts.get(key, 0) + count
+            if len(self._counts) > self.size:
+                keep = sorted(self._counts.items(), key=lambda item: -item[1])
+                self._counts = dict(keep[:self.size // 2])
+        finally:
+            self._lock.release()
+
+    def most_common(self, limit):
+        """Return the `limit` most frequent `(key, count)` pairs."""
+        self._lock.acquire()
+        try:
+            items = sorted(self._counts.items(), key=lambda item: -item[1])
+        finally:
+            self._lock.release()
+        return items[:limit]
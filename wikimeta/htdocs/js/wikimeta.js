@@ -0,0 +1,23 @@
+// Wikimeta: complete the owner fields from /wikimeta/users
+jQuery(document).ready(function($) {
+  $('input[data-autocomplete]').each(function() {
+    var input = $(this);
+    var list = $('#' + input.attr('list'));
+    // keep the options rendered with the page until the user types
+    var last = list.children().length ? input.val() : null;
+    input.bind('keyup focus', function() {
+      var prefix = input.val();
+      if (prefix === last)
+        return;
+      last = prefix;
+      $.getJSON(input.attr('data-autocomplete'), {q: prefix}, function(users) {
+        if (prefix !== last)
+          return;
+        list.empty();
+        $.each(users, function(index, user) {
+          list.append($('<option/>').attr('value', user));
+        });
+      });
+    });
+  });
+});
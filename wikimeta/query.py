@@ -0,0 +1,177 @@
+# Wikimeta query layer
+
+from search import split_words
+
+ALL_STATES = 'all (non-obsolete)'
+ALL_OWNERS = 'all'
+
+
+def format_cursor(row):
+    """Return the keyset pagination cursor for a `(name, owner, state,
+    priority, time, author)` row."""
+    return '%d:%r:%s' % (int(row[3]), float(row[4]), row[0])
+
+
+def parse_cursor(value):
+    """Return `(priority, time, name)` for a cursor, or None if invalid."""
+    if not value:
+        return None
+    try:
+        priority, t, name = value.split(':', 2)
+        return int(priority), float(t), name
+    except ValueError:
+        return None
+
+
+class MetaQuery(object):
+    """Filter over the current wikimeta rows (the `wikimeta_current` table).
+
+    State, owner and tag predicates are evaluated by the database in a single
+    joined query. Each word of `text` must be the prefix of a word of the
+    page, as recorded in the `wikimeta_words` index. Results are ordered by `(priority desc, time desc, name)`
+    and can be fetched a page at a time with keyset cursors.
+    """
+    def __init__(self, state=ALL_STATES, owner=ALL_OWNERS, tags=None, text=None):
+        self.state = state
+        self.owner = owner
+        self.tags = list(tags or [])
+        self.words = sorted(split_words(text))
+
+    def _from_where(self, db):
+        sql = ["FROM wikimeta_current m"]
+        args = []
+        for index, tag in enumerate(self.tags):
+            sql.append("INNER JOIN tags t%d ON t%d.tagspace='wiki' "
+                       "AND t%d.name=m.name AND t%d.tag=%%s"
+                       % (index, index, index, index))
+            args.append(tag)
+        where = []
+        if self.state == ALL_STATES:
+            where.append("m.state<>'obsolete'")
+        elif self.state:
+            where.append("m.state=%s")
+            args.append(self.state)
+        if self.owner and self.owner != ALL_OWNERS:
+            where.append("m.owner=%s")
+            args.append(self.owner)
+        for word in self.words:
+            where.append("m.name IN (SELECT name FROM wikimeta_words "
+                         "WHERE word %s)" % db.like())
+            args.append(db.like_escape(word) + '%')
+        return sql, where, args
+
+    def execute(self, db, after=None, before=None, limit=None):
+        """Return the matching `(name, owner, state, priority, time, author)`
+        rows.
+
+        `after` and `before` are `(priority, time, name)` tuples as returned
+        by `parse_cursor`; only rows sorting after (or before) that position
+        are returned. With `before`, the rows closest to the position are
+        selected, but the result is still returned in display order.
+        """
+        sql, where, args = self._from_where(db)
+        sql.insert(0, "SELECT m.name, m.owner, m.state, m.priority, m.time, "
+                      "m.author")
+        if after is not None:
+            where.append("(m.priority<%s OR (m.priority=%s AND "
+                         "(m.time<%s OR (m.time=%s AND m.name>%s))))")
+            args += [after[0], after[0], after[1], after[1], after[2]]
+        if before is not None:
+            where.append("(m.priority>%s OR (m.priority=%s AND "
+                         "(m.time>%s OR (m.time=%s AND m.name<%s))))")
+            args += [before[0], before[0], before[1], before[1], before[2]]
+        if where:
+            sql.append("WHERE " + " AND ".join(where))
+        if before is not None:
+            sql.append("ORDER BY m.priority, m.time, m.name DESC")
+        else:
+            sql.append("ORDER BY m.priority DESC, m.time DESC, m.name")
+        if limit:
+            sql.append("LIMIT %d" % int(limit))
+        cursor = db.cursor()
+        cursor.execute(' '.join(sql), args)
+        rows = list(cursor)
+        if before is not None:
+            rows.reverse()
+        return rows
+
+    def iterate(self, db, batch_size=1000):
+        """Generate all matching rows in display order, fetched from the
+        cursor in batches.
+
+        The rows are `(name, owner, state, priority, time, author,
+        wiki_time)`, where `wiki_time` is the time of the newest version of
+        the wiki page (in microseconds) or None.
+        """
+        sql, where, args = self._from_where(db)
+        sql.insert(0, "SELECT m.name, m.owner, m.state, m.priority, m.time, "
+                      "m.author, (SELECT max(w.time) FROM wiki w "
+                      "WHERE w.name=m.name)")
+        if where:
+            sql.append("WHERE " + " AND ".join(where))
+        sql.append("ORDER BY m.priority DESC, m.time DESC, m.name")
+        cursor = db.cursor()
+        cursor.execute(' '.join(sql), args)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+
+    def facets(self, db):
+        """Return the result counts of the filter options, as `(states,
+        owners, tags)` dicts from option value to number of pages.
+
+        The state counts apply the owner, tag and text predicates, the owner
+        counts the state, tag and text predicates, and the tag counts all
+        predicates: they are the sizes of the results after selecting that
+        option instead of (or, for tags, in addition to) the current one.
+        """
+        cursor = db.cursor()
+        sql, where, args = MetaQuery(None, None, self.tags,
+                                     ' '.join(self.words))._from_where(db)
+        sql.insert(0, "SELECT m.state, m.owner, count(*)")
+        if where:
+            sql.append("WHERE " + " AND ".join(where))
+        sql.append("GROUP BY m.state, m.owner")
+        cursor.execute(' '.join(sql), args)
+        states = {}
+        owners = {}
+        for state, owner, count in cursor:
+            if not self.owner or self.owner == ALL_OWNERS or owner == self.owner:
+                states[state] = states.get(state, 0) + count
+                if state != 'obsolete':
+                    states[ALL_STATES] = states.get(ALL_STATES, 0) + count
+            if self.state == ALL_STATES and state != 'obsolete' or \
+                    not self.state or state == self.state:
+                owners[owner] = owners.get(owner, 0) + count
+
+        sql, where, args = self._from_where(db)
+        sql.insert(0, "SELECT f.tag, count(*)")
+        sql.append("INNER JOIN tags f ON f.tagspace='wiki' AND f.name=m.name")
+        if where:
+            sql.append("WHERE " + " AND ".join(where))
+        sql.append("GROUP BY f.tag")
+        cursor.execute(' '.join(sql), args)
+        tags = dict(cursor.fetchall())
+        return states, owners, tags
+
+    def neighbour(self, db, name, above=True):
+        """Return the name of the matching page shown just above (or below)
+        page `name`, or None."""
+        cursor = db.cursor()
+        cursor.execute("""
+            SELECT priority, time FROM wikimeta_current WHERE name=%s
+            """, (name,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        position = (int(row[0]), float(row[1]), name)
+        if above:
+            rows = self.execute(db, before=position, limit=1)
+        else:
+            rows = self.execute(db, after=position, limit=1)
+        if rows:
+            return rows[0][0]
+        return None
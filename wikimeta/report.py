@@ -0,0 +1,226 @@
+# Wikimeta state transition rollups
+
+from datetime import date, timedelta
+
+# Kinds of rollup rows: all pages, the pages of one owner, or of one tag.
+REPORT_KINDS = ['all', 'owner', 'tag']
+REPORT_PERIODS = ['day', 'week', 'month']
+
+_epoch = date(1970, 1, 1)
+
+
+def transitions(old, new, tags):
+    """Return the `(kind, value, old_state, new_state)` transitions of a page
+    whose `(owner, state)` changes from `old` to `new`.
+
+    `old` is None for a page without meta data yet, and `new` is None for a
+    deleted page; the missing state is recorded as ''. A change of owner
+    counts as leaving the queue of the old owner and entering the one of the
+    new owner. Tags are the page's tags at the time of the change; adding or
+    removing them is counted by `tag_transitions()`.
+    """
+    old_state = old is not None and old[1] or ''
+    new_state = new is not None and new[1] or ''
+    result = []
+    if old_state != new_state:
+        result.append(('all', '', old_state, new_state))
+        result.extend([('tag', tag, old_state, new_state) for tag in tags])
+    if old is not None and new is not None and old[0] == new[0]:
+        if old_state != new_state:
+            result.append(('owner', new[0] or '', old_state, new_state))
+    else:
+        if old is not None:
+            result.append(('owner', old[0] or '', old_state, ''))
+        if new is not None:
+            result.append(('owner', new[0] or '', '', new_state))
+    return result
+
+
+def tag_transitions(state, added, removed):
+    """Return the `(kind, value, old_state, new_state)` transitions of a page
+    in `state` whose tags `added` and `removed` change: like a change of
+    owner, the page enters the queue of an added tag and leaves the one of a
+    removed tag."""
+    return ([('tag', tag, state, '') for tag in removed] +
+            [('tag', tag, '', state) for tag in added])
+
+
+def _count(changes):
+    counts = {}
+    for t, old, new, tags in changes:
+        day = int(float(t) // 86400)
+        for transition in transitions(old, new, tags):
+            key = (day,) + transition
+            counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def _store(cursor, counts):
+    for key, count in counts.items():
+        cursor.execute("""
+            UPDATE wikimeta_daily SET count=count+%s
+             WHERE day=%s AND kind=%s AND value=%s AND old_state=%s AND new_state=%s
+            """, (count,) + key)
+        if cursor.rowcount == 0:
+            cursor.execute("""
+                INSERT INTO wikimeta_daily (day, kind, value, old_state, new_state, count)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                """, key + (count,))
+
+
+def record_transitions(cursor, changes):
+    """Add `(time, old, new, tags)` page changes to the daily rollups, see
+    `transitions()`."""
+    _store(cursor, _count(changes))
+
+
+def _current_meta(cursor, names, batch_size=500):
+    """Return `(meta, tags)` dicts with the current `(owner, state)` and the
+    tags of the pages `names`."""
+    meta = {}
+    tags = {}
+    for start in range(0, len(names), batch_size):
+        batch = list(names[start:start + batch_size])
+        marks = ','.join(['%s'] * len(batch))
+        cursor.execute("""
+            SELECT name, owner, state FROM wikimeta_current WHERE name IN (%s)
+            """ % marks, batch)
+        for name, owner, state in cursor:
+            meta[name] = (owner, state)
+        cursor.execute("""
+            SELECT name, tag FROM tags WHERE tagspace='wiki' AND name IN (%s)
+            """ % marks, batch)
+        for name, tag in cursor:
+            tags.setdefault(name, []).append(tag)
+    return meta, tags
+
+
+def record_meta_rows(cursor, rows):
+    """Add the transitions of `(name, owner, state, priority, time, author)`
+    rows to the daily rollups. Must be called before the rows are written."""
+    meta, tags = _current_meta(cursor, [row[0] for row in rows])
+    record_transitions(cursor, [(row[4], meta.get(row[0]), (row[1], row[2]),
+                                 tags.get(row[0], ())) for row in rows])
+
+
+def record_tag_changes(cursor, t, changes):
+    """Add the `(name, added, removed)` tag changes of pages at time `t` to
+    the daily rollups, see `tag_transitions()`. Pages without meta data are
+    not in any queue and are skipped."""
+    meta = _current_meta(cursor, [change[0] for change in changes])[0]
+    day = int(float(t) // 86400)
+    counts = {}
+    for name, added, removed in changes:
+        if name not in meta:
+            continue
+        for transition in tag_transitions(meta[name][1], added, removed):
+            key = (day,) + transition
+            counts[key] = counts.get(key, 0) + 1
+    _store(cursor, counts)
+
+
+def record_deletions(cursor, names, t):
+    """Add the deletion of pages at time `t` to the daily rollups. Must be
+    called before the current meta data of the pages is removed."""
+    meta, tags = _current_meta(cursor, names)
+    record_transitions(cursor, [(t, meta[name], None, tags.get(name, ()))
+                                for name in names if name in meta])
+
+
+def rebuild_rollups(cursor, history_sql):
+    """Recompute the daily rollups from all history rows selected by
+    `history_sql`.
+
+    The history does not record when a page was deleted, so pages without
+    current meta data are counted as deleted at the time of their last row.
+    Nor does it record tag changes: a page is counted under its current tags
+    from its first row on, which ends in the same open counts as the tag
+    changes recorded by `record_tag_changes()`.
+    """
+    cursor.execute("SELECT name, tag FROM tags WHERE tagspace='wiki'")
+    tags = {}
+    for name, tag in cursor:
+        tags.setdefault(name, []).append(tag)
+    cursor.execute("SELECT name FROM wikimeta_current")
+    current = set(row[0] for row in cursor)
+    cursor.execute("""
+        SELECT name, owner, state, time FROM (%s) h ORDER BY name, time
+        """ % history_sql)
+    changes = []
+    previous = {}
+    last_time = {}
+    for name, owner, state, t in cursor.fetchall():
+        changes.append((t, previous.get(name), (owner, state), tags.get(name, ())))
+        previous[name] = (owner, state)
+        last_time[name] = t
+    for name in previous:
+        if name not in current:
+            changes.append((last_time[name], previous[name], None,
+                            tags.get(name, ())))
+    cursor.execute("DELETE FROM wikimeta_daily")
+    cursor.executemany("""
+        INSERT INTO wikimeta_daily (day, kind, value, old_state, new_state, count)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        """, [key + (count,) for key, count in _count(changes).items()])
+
+
+def _period_start(day, period):
+    start = _epoch + timedelta(days=day)
+    if period == 'week':
+        return start - timedelta(days=start.weekday())
+    if period == 'month':
+        return start.replace(day=1)
+    return start
+
+
+def _next_period(start, period):
+    if period == 'week':
+        return start + timedelta(days=7)
+    if period == 'month':
+        if start.month == 12:
+            return start.replace(year=start.year + 1, month=1)
+        return start.replace(month=start.month + 1)
+    return start + timedelta(days=1)
+
+
+def _is_open(state):
+    return state not in ('', 'obsolete')
+
+
+def summarize(db, kind, value, period='week'):
+    """Return the transitions and open pages of one rollup dimension per
+    period.
+
+    The result is `(pairs, periods)`: the sorted `(old_state, new_state)`
+    pairs that occur, and a `(start date, {pair: count}, open count)` tuple
+    for each period from the first change on, where the open count is the
+    number of non-obsolete pages at the end of the period.
+    """
+    cursor = db.cursor()
+    cursor.execute("""
+        SELECT day, old_state, new_state, sum(count) FROM wikimeta_daily
+         WHERE kind=%s AND value=%s
+         GROUP BY day, old_state, new_state ORDER BY day
+        """, (kind, value))
+    rows = cursor.fetchall()
+    pairs = set()
+    periods = []
+    if not rows:
+        return [], periods
+    start = _period_start(rows[0][0], period)
+    counts = {}
+    open_pages = 0
+    index = 0
+    while index < len(rows):
+        end = _next_period(start, period)
+        while index < len(rows) and _epoch + timedelta(days=rows[index][0]) < end:
+            day, old_state, new_state, count = rows[index]
+            pair = (old_state, new_state)
+            pairs.add(pair)
+            counts[pair] = counts.get(pair, 0) + int(count)
+            open_pages += (_is_open(new_state) - _is_open(old_state)) * int(count)
+            index += 1
+        periods.append((start, counts, open_pages))
+        start = end
+        counts = {}
+    return sorted(pairs), periods
@@ -0,0 +1,48 @@
+# Wikimeta word index for the text filter
+
+import re
+
+_word_re = re.compile(r'\w+', re.UNICODE)
+
+MIN_WORD_LENGTH = 2
+MAX_WORD_LENGTH = 64
+
+
+def split_words(text):
+    """Return the distinct lower-case words of `text` worth indexing."""
+    return set(word for word in _word_re.findall((text or '').lower())
+               if MIN_WORD_LENGTH <= len(word) <= MAX_WORD_LENGTH)
+
+
+def index_page(cursor, name, text):
+    """Replace the indexed words of page `name` by the words of `text`."""
+    cursor.execute("DELETE FROM wikimeta_words WHERE name=%s", (name,))
+    cursor.executemany("""
+        INSERT INTO wikimeta_words (word, name) VALUES (%s, %s)
+        """, [(word, name) for word in split_words(text)])
+
+
+def remove_page(cursor, name):
+    cursor.execute("DELETE FROM wikimeta_words WHERE name=%s", (name,))
+
+
+def rename_page(cursor, old_name, new_name):
+    cursor.execute("""
+        UPDATE wikimeta_words SET name=%s WHERE name=%s
+        """, (new_name, old_name))
+
+
+def reindex_all(cursor):
+    """Rebuild the word index from the newest version of every wiki page.
+    Returns the number of pages indexed."""
+    cursor.execute("DELETE FROM wikimeta_words")
+    cursor.execute("""
+        SELECT w.name, w.text FROM wiki w
+         WHERE w.version=(SELECT max(v.version) FROM wiki v WHERE v.name=w.name)
+        """)
+    rows = [(word, name) for name, text in cursor.fetchall()
+            for word in split_words(text)]
+    cursor.executemany("""
+        INSERT INTO wikimeta_words (word, name) VALUES (%s, %s)
+        """, rows)
+    return len(set(name for word, name in rows))
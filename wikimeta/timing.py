@@ -0,0 +1,147 @@
+# Wikimeta request profiling
+
+import threading
+import time
+
+from collections import deque
+
+_current = threading.local()
+
+
+class RequestTimings(object):
+    """Counts and durations of the work done for one request.
+
+    Durations are accumulated per name, e.g. 'sql', 'render', 'tags' and
+    'sidebar', together with the number of times each was measured.
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.durations = {}
+        self.counts = {}
+
+    def add(self, name, seconds, count=1):
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+        self.counts[name] = self.counts.get(name, 0) + count
+
+    def server_timing(self):
+        """Return the value of a `Server-Timing` response header."""
+        metrics = ['%s;dur=%.1f;desc="%d"' % (name, self.durations[name] * 1000,
+                                               self.counts[name])
+                   for name in sorted(self.durations)]
+        metrics.append('total;dur=%.1f' % ((time.time() - self.start) * 1000))
+        return ', '.join(metrics)
+
+
+class timer(object):
+    """Context manager adding the time of its block to the current request.
+
+        with timer('render'):
+            ...
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        timings = current()
+        if timings is not None:
+            timings.add(self.name, time.time() - self.start)
+        return False
+
+
+def begin():
+    """Start collecting timings for the request handled by this thread."""
+    _current.timings = RequestTimings()
+    return _current.timings
+
+def end():
+    """Stop collecting and return the timings of the current request."""
+    timings = getattr(_current, 'timings', None)
+    _current.timings = None
+    return timings
+
+def current():
+    return getattr(_current, 'timings', None)
+
+
+class TimedCursor(object):
+    """Cursor wrapper counting the statements of the current request."""
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, sql, args=None):
+        start = time.time()
+        try:
+            if args is None:
+                return self._cursor.execute(sql)
+            return self._cursor.execute(sql, args)
+        finally:
+            timings = current()
+            if timings is not None:
+                timings.add('sql', time.time() - start)
+
+    def executemany(self, sql, args):
+        start = time.time()
+        try:
+            return self._cursor.executemany(sql, args)
+        finally:
+            timings = current()
+            if timings is not None:
+                timings.add('sql', time.time() - start)
+
+
+class TimedConnection(object):
+    """Connection wrapper handing out `TimedCursor`s."""
+    def __init__(self, cnx):
+        self._cnx = cnx
+
+    def __getattr__(self, name):
+        return getattr(self._cnx, name)
+
+    def cursor(self):
+        return TimedCursor(self._cnx.cursor())
+
+
+class RollingStats(object):
+    """Durations of the last `size` profiled requests, per name."""
+    def __init__(self, size=1000):
+        self.size = size
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, timings):
+        self._lock.acquire()
+        try:
+            samples = dict(timings.durations)
+            samples['total'] = time.time() - timings.start
+            for name, seconds in samples.items():
+                if name not in self._samples:
+                    self._samples[name] = deque(maxlen=self.size)
+                self._samples[name].append(seconds)
+        finally:
+            self._lock.release()
+
+    def percentiles(self, points=(50, 90, 99)):
+        """Return `(name, count, [milliseconds per point])` tuples."""
+        self._lock.acquire()
+        try:
+            samples = dict((name, sorted(values))
+                           for name, values in self._samples.items())
+        finally:
+            self._lock.release()
+        result = []
+        for name in sorted(samples):
+            values = samples[name]
+            result.append((name, len(values),
+                           [values[min(len(values) - 1, len(values) * p // 100)] * 1000
+                            for p in points]))
+        return result
@@ -0,0 +1,94 @@
+# Wikimeta database connections and transactions
+
+import threading
+
+from trac.web.api import RequestDone
+
+from timing import TimedConnection, current
+
+_scope = threading.local()
+
+
+def _transactions():
+    """Return the open transactions of this thread, by environment path."""
+    transactions = getattr(_scope, 'transactions', None)
+    if transactions is None:
+        transactions = _scope.transactions = {}
+    return transactions
+
+
+class Transaction(object):
+    """Connection shared by the code inside a `transaction` block.
+
+    `commit()` does nothing; the block commits once when it ends. Callbacks
+    registered with `after_commit` run after that commit.
+    """
+    def __init__(self, db):
+        self._db = db
+        self.callbacks = []
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    def cursor(self):
+        return self._db.cursor()
+
+    def commit(self):
+        pass
+
+
+class transaction(object):
+    """Context manager making the writes of its block one transaction.
+
+        with transaction(env) as db:
+            ...
+
+    Inside the block, `get_db(env)` returns the same connection on this
+    thread, so helpers that commit on their own join the transaction. Blocks
+    nest; only the outermost one commits, or rolls back on an exception.
+    `RequestDone`, raised by redirects and sent responses, commits.
+    """
+    def __init__(self, env):
+        self.env = env
+
+    def __enter__(self):
+        transactions = _transactions()
+        self.outermost = self.env.path not in transactions
+        if self.outermost:
+            transactions[self.env.path] = Transaction(get_db(self.env))
+        return transactions[self.env.path]
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if not self.outermost:
+            return False
+        db = _transactions().pop(self.env.path)
+        if exc_type is None or issubclass(exc_type, RequestDone):
+            db._db.commit()
+            for callback in db.callbacks:
+                callback()
+        else:
+            db._db.rollback()
+        return False
+
+
+def after_commit(env, callback):
+    """Call `callback` when the open transaction of `env` on this thread has
+    been committed, or at once if there is none."""
+    db = _transactions().get(env.path)
+    if db is None:
+        callback()
+    else:
+        db.callbacks.append(callback)
+
+
+def get_db(env):
+    """Return the connection of the open transaction of `env` on this
+    thread, or else a new connection. Statements are counted while a request
+    is being profiled."""
+    db = _transactions().get(env.path)
+    if db is not None:
+        return db
+    db = env.get_db_cnx()
+    if current() is None:
+        return db
+    return TimedConnection(db)
@@ -1,3 +1,55 @@
+# Wikimeta module
+from trac.db import Table, Column, Index, DatabaseManager
 
 def do_upgrade(env, ver, cursor):
-    pass # Change the database schema here
+    """Add indexes for the current-row lookups and priority ranges, and the
+    one-row-per-page `wikimeta_current` table."""
+    wikimeta = Table('wikimeta', key=['name', 'owner', 'state', 'time'])[
+        Column('name', type='text'),
+        Column('owner', type='text'),
+        Column('state', type='text'),
+        Column('priority', type='int(11)'),
+        Column('time', type='bigint(20)'),
+        Column('author', type='text'),
+        Column('current', type='int(11)'),
+        Index(['name', 'current']),
+        Index(['current', 'priority'])]
+    wikimeta_current = Table('wikimeta_current', key='name')[
+        Column('name', type='text'),
+        Column('owner', type='text'),
+        Column('state', type='text'),
+        Column('priority', type='int(11)'),
+        Column('time', type='bigint(20)'),
+        Column('author', type='text'),
+        Index(['state', 'priority']),
+        Index(['owner']),
+        Index(['priority', 'time'])]
+
+    # recreate wikimeta with its indexes
+    cursor.execute("""
+        CREATE TEMPORARY TABLE wikimeta_old AS SELECT * FROM wikimeta
+        """)
+    cursor.execute("DROP TABLE wikimeta")
+    connector = DatabaseManager(env)._get_connector()[0]
+    for table in (wikimeta, wikimeta_current):
+        for stmt in connector.to_sql(table):
+            cursor.execute(stmt)
+    cursor.execute("""
+        INSERT INTO wikimeta (name, owner, state, priority, time, author, current)
+        SELECT name, owner, state, priority, time, author, current
+          FROM wikimeta_old
+        """)
+    cursor.execute("DROP TABLE wikimeta_old")
+
+    # fill the current-state table, keeping the newest current row per page
+    cursor.execute("""
+        SELECT name, owner, state, priority, time, author
+          FROM wikimeta WHERE current=1 ORDER BY time
+        """)
+    current = {}
+    for row in cursor:
+        current[row[0]] = row
+    cursor.executemany("""
+        INSERT INTO wikimeta_current (name, owner, state, priority, time, author)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        """, current.values())
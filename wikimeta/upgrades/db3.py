@@ -0,0 +1,17 @@
+# Wikimeta module
+from trac.db import Table, Column, Index, DatabaseManager
+
+def do_upgrade(env, ver, cursor):
+    """Add the wikimeta_archive table for compacted history rows."""
+    wikimeta_archive = Table('wikimeta_archive', key=['name', 'owner', 'state', 'time'])[
+        Column('name', type='text'),
+        Column('owner', type='text'),
+        Column('state', type='text'),
+        Column('priority', type='int(11)'),
+        Column('time', type='bigint(20)'),
+        Column('author', type='text'),
+        Column('current', type='int(11)'),
+        Index(['time'])]
+    connector = DatabaseManager(env)._get_connector()[0]
+    for stmt in connector.to_sql(wikimeta_archive):
+        cursor.execute(stmt)
@@ -0,0 +1,22 @@
+# Wikimeta module
+from trac.db import Table, Column, Index, DatabaseManager
+
+def do_upgrade(env, ver, cursor):
+    """Index tags_category by tag for the uncategorized-tags anti-join."""
+    tags_category = Table('tags_category', key=('category', 'tag'))[
+        Column('category'),
+        Column('tag'),
+        Index(['tag'])]
+
+    cursor.execute("""
+        CREATE TEMPORARY TABLE tags_category_old AS SELECT * FROM tags_category
+        """)
+    cursor.execute("DROP TABLE tags_category")
+    connector = DatabaseManager(env)._get_connector()[0]
+    for stmt in connector.to_sql(tags_category):
+        cursor.execute(stmt)
+    cursor.execute("""
+        INSERT INTO tags_category (category, tag)
+        SELECT category, tag FROM tags_category_old
+        """)
+    cursor.execute("DROP TABLE tags_category_old")
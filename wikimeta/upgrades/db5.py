@@ -0,0 +1,7 @@
+# Wikimeta module
+
+def do_upgrade(env, ver, cursor):
+    """Index wikimeta_current by time for the conditional GET validator."""
+    cursor.execute("""
+        CREATE INDEX wikimeta_current_time_idx ON wikimeta_current (time)
+        """)
@@ -0,0 +1,15 @@
+# Wikimeta module
+from trac.db import Table, Column, Index, DatabaseManager
+
+from wikimeta.search import reindex_all
+
+def do_upgrade(env, ver, cursor):
+    """Add the wikimeta_words index of page text and fill it."""
+    wikimeta_words = Table('wikimeta_words', key=('word', 'name'))[
+        Column('word'),
+        Column('name'),
+        Index(['name'])]
+    connector = DatabaseManager(env)._get_connector()[0]
+    for stmt in connector.to_sql(wikimeta_words):
+        cursor.execute(stmt)
+    reindex_all(cursor)
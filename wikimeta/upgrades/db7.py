@@ -0,0 +1,27 @@
+# Wikimeta module
+from trac.db import Table, Column, Index, DatabaseManager
+
+from wikimeta.report import rebuild_rollups
+
+HISTORY_SQL = """
+    SELECT name, owner, state, priority, time, author, current FROM wikimeta
+    UNION ALL
+    SELECT name, owner, state, priority, time, author, current FROM wikimeta_archive
+    """
+
+def do_upgrade(env, ver, cursor):
+    """Add the daily rollups of the state transitions and compute them from
+    the history."""
+    wikimeta_daily = Table('wikimeta_daily',
+                           key=('day', 'kind', 'value', 'old_state', 'new_state'))[
+        Column('day', type='int'),
+        Column('kind'),
+        Column('value'),
+        Column('old_state'),
+        Column('new_state'),
+        Column('count', type='int'),
+        Index(['kind', 'value', 'day'])]
+    connector = DatabaseManager(env)._get_connector()[0]
+    for stmt in connector.to_sql(wikimeta_daily):
+        cursor.execute(stmt)
+    rebuild_rollups(cursor, HISTORY_SQL)
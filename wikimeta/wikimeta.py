@@ -1,36 +1,61 @@
 # Wikimeta plugin
 
+import csv
 import re
+import threading
 import time
 
+from StringIO import StringIO
+from collections import namedtuple
+
+from email.utils import mktime_tz, parsedate_tz
+from hashlib import sha1
+from multiprocessing.pool import ThreadPool
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
 from genshi.builder import tag
-from genshi.filters.transform import Transformer
-from genshi.core import Markup
+from genshi.core import START, Markup, Stream
 
 from trac.core import *
+from trac.config import BoolOption, IntOption
 from trac.web import IRequestHandler
-from trac.web.chrome import INavigationContributor, ITemplateProvider, add_stylesheet
+from trac.web.api import RequestDone
+from trac.web.href import Href
+from trac.web.chrome import INavigationContributor, ITemplateProvider, add_script, add_stylesheet
 from trac.env import *
 from trac.db.api import DatabaseManager
-from trac.db.schema import Table, Column
+from trac.db.schema import Table, Column, Index
 from trac.web.api import IRequestFilter, ITemplateStreamFilter
 from trac.wiki.api import IWikiChangeListener, IWikiPageManipulator, IWikiSyntaxProvider
-from trac.wiki.api import WikiSystem
+from trac.wiki.api import WikiSystem, parse_args
 from trac.wiki.formatter import system_message, HtmlFormatter
 from trac.wiki.macros import WikiMacroBase
 from trac.wiki.model import WikiPage
 from trac.util import get_reporter_id
+from trac.util.datefmt import from_utimestamp, http_date, to_datetime, to_utimestamp, utc
 from trac.mimeview import Context
 from trac.resource import Resource, render_resource_link, get_resource_url
-from trac.perm import IPermissionPolicy, IPermissionRequestor
+from trac.perm import IPermissionPolicy, IPermissionRequestor, PermissionCache
 from trac.perm import PermissionError, PermissionSystem
 
-from tractags.model import tag_resource
+
+from cache import HitCounter, LRUCache, PrefixIndex, TagIndex
+from timing import RollingStats, begin, end, timer
+from transaction import after_commit, get_db, transaction
+from query import ALL_OWNERS, ALL_STATES, MetaQuery, format_cursor, parse_cursor
+from search import index_page, reindex_all, remove_page, rename_page
+from report import REPORT_KINDS, REPORT_PERIODS, rebuild_rollups, record_deletions, \
+        record_meta_rows, record_tag_changes, summarize
 
 
 PLUGIN_NAME = 'WikiMetaPlugin'
-PLUGIN_DB_VERSION = 1
+PLUGIN_DB_VERSION = 7
 PLUGIN_SCHEMA = [
+    # full history of the meta data, one current=1 row per page:
     Table('wikimeta', key=['name', 'owner', 'state', 'time'])[
         Column('name', type='text'),
         Column('owner', type='text'),
@@ -38,23 +63,102 @@ PLUGIN_SCHEMA = [
         Column('priority', type='int(11)'),
         Column('time', type='bigint(20)'),
         Column('author', type='text'),
-        Column('current', type='int(11)')],
+        Column('current', type='int(11)'),
+        # (the priority of a row is the rank when it was written; the live
+        # rank is in wikimeta_current)
+        Index(['name', 'current']),
+        Index(['current', 'priority'])],
+    # copy of the current=1 rows, kept in step by PageMeta.insert:
+    Table('wikimeta_current', key='name')[
+        Column('name', type='text'),
+        Column('owner', type='text'),
+        Column('state', type='text'),
+        Column('priority', type='int(11)'),
+        Column('time', type='bigint(20)'),
+        Column('author', type='text'),
+        Index(['state', 'priority']),
+        Index(['owner']),
+        # (not ['priority'] alone: its name, wikimeta_current_priority_idx,
+        # is taken by the ['current', 'priority'] index of wikimeta)
+        Index(['priority', 'time']),
+        Index(['time'])],
+    # non-current history rows moved out of wikimeta by `wikimeta compact`:
+    Table('wikimeta_archive', key=['name', 'owner', 'state', 'time'])[
+        Column('name', type='text'),
+        Column('owner', type='text'),
+        Column('state', type='text'),
+        Column('priority', type='int(11)'),
+        Column('time', type='bigint(20)'),
+        Column('author', type='text'),
+        Column('current', type='int(11)'),
+        Index(['time'])],
     Table('tags_category', key=('category', 'tag'))[
         Column('category'),
-        Column('tag')]
+        Column('tag'),
+        Index(['tag'])],
+    # words of the newest version of each wiki page, for the text filter:
+    Table('wikimeta_words', key=('word', 'name'))[
+        Column('word'),
+        Column('name'),
+        Index(['name'])],
+    # state transitions per day, of all pages and per owner and tag:
+    Table('wikimeta_daily', key=('day', 'kind', 'value', 'old_state', 'new_state'))[
+        Column('day', type='int'),
+        Column('kind'),
+        Column('value'),
+        Column('old_state'),
+        Column('new_state'),
+        Column('count', type='int'),
+        Index(['kind', 'value', 'day'])]
     ]
 
+# All history rows, including the ones archived by `wikimeta compact`.
+# Reports over the history must read this instead of the wikimeta table.
+HISTORY_SQL = """
+    SELECT name, owner, state, priority, time, author, current FROM wikimeta
+    UNION ALL
+    SELECT name, owner, state, priority, time, author, current FROM wikimeta_archive
+    """
+
 STATES = [ 'planned', 'nice to have', 'current', 'obsolete' ]
 
-def _create_select(label_text, id, name, options, selected_name=None, default_selection=None):
-    select = tag.select(id=id, name=name)
+# Number of filter combinations whose option counts are cached.
+FACET_CACHE_SIZE = 200
+
+# Number of WikiMeta macro argument sets whose results are cached.
+MACRO_CACHE_SIZE = 200
+
+# Seconds the cache warmer waits after an invalidation, so that a burst of
+# changes is warmed up once.
+WARM_DELAY = 2
+
+# Planned pages are ranked by priority, highest first. Ranks are spaced
+# PRIORITY_GAP apart so that moving a page only changes its own row.
+PRIORITY_GAP = 1024
+
+# The rank for the next page added to the planned pages.
+NEXT_PRIORITY_SQL = """
+    SELECT COALESCE(max(priority), 0) + %d FROM wikimeta_current
+    """ % PRIORITY_GAP
+
+def _create_select(label_text, id, name, options, selected_name=None, default_selection=None,
+                   autocomplete_url=None):
     if selected_name is None and default_selection is not None:
         selected_name = default_selection
-    for option_name in options:
-        if option_name == selected_name:
-            select.append(tag.option(option_name, value=option_name, selected='selected'))
-        else:
-            select.append(tag.option(option_name, value=option_name))
+    if autocomplete_url is not None:
+        # a text field completed from the JSON endpoint by wikimeta.js
+        select = tag(tag.input(type='text', id=id, name=name, value=selected_name,
+                               size='10', list='%s_list' % id,
+                               data_autocomplete=autocomplete_url),
+                     tag.datalist([tag.option(value=option_name) for option_name in options],
+                                  id='%s_list' % id))
+    else:
+        select = tag.select(id=id, name=name)
+        for option_name in options:
+            if option_name == selected_name:
+                select.append(tag.option(option_name, value=option_name, selected='selected'))
+            else:
+                select.append(tag.option(option_name, value=option_name))
     insert = tag(label_text)
     insert(
         tag.br(), select
@@ -62,9 +166,129 @@ def _create_select(label_text, id, name, options, selected_name=None, default_se
     insert = tag.div(tag.label(insert), class_='field')
     return insert
 
+def _prepend_to_id(stream, element_id, content):
+    """Generate the events of `stream`, with the events of `content` inserted
+    at the start of the first element with id `element_id`.
+
+    This is a single pass over the events, without the buffering and path
+    matching of a `Transformer`."""
+    found = False
+    for kind, data, pos in stream:
+        yield kind, data, pos
+        if not found and kind is START and data[1].get('id') == element_id:
+            found = True
+            for event in content.generate():
+                yield event
+
+# Metadata-only export of the filtered view, see WikiMetaPlugin._process_export
+EXPORT_FORMATS = {'json': 'application/json', 'csv': 'text/csv'}
+EXPORT_FIELDS = ['name', 'owner', 'state', 'priority', 'time', 'author', 'tags', 'last_modified']
+
+def _export_json(records):
+    """Generate a JSON array of export records, one line per record."""
+    separator = '[\n'
+    for record in records:
+        yield separator + json.dumps(record)
+        separator = ',\n'
+    if separator == '[\n':
+        yield '['
+    yield '\n]\n'
+
+def _export_csv(records):
+    """Generate UTF-8 CSV lines with a header line for export records."""
+    out = StringIO()
+    writer = csv.writer(out)
+    writer.writerow(EXPORT_FIELDS)
+    for record in records:
+        values = [record[field] for field in EXPORT_FIELDS]
+        values[EXPORT_FIELDS.index('tags')] = ' '.join(record['tags'])
+        writer.writerow([value is not None and (u'%s' % value).encode('utf-8') or ''
+                         for value in values])
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+
+# Bulk page import, see WikiMetaPlugin._import_pages
+IMPORT_FIELDS = ['name', 'owner', 'state', 'priority', 'tags', 'text']
+IMPORT_BATCH_SIZE = 500
+
+def _read_import_csv(fileobj):
+    """Return the records of a UTF-8 CSV file with a header line naming
+    some of the IMPORT_FIELDS, as dicts with all of the fields.
+
+    Empty names are allowed, the pages get unused names when imported. Empty
+    states default to planned, empty priorities to the next free rank.
+    """
+    reader = csv.DictReader(fileobj)
+    if not reader.fieldnames or not set(reader.fieldnames) & set(IMPORT_FIELDS):
+        raise TracError('The CSV file needs a header line with the columns %s'
+                        % ', '.join(IMPORT_FIELDS))
+    records = []
+    names = set()
+    for values in reader:
+        line = reader.line_num
+        record = dict((field, (values.get(field) or '').decode('utf-8').strip())
+                      for field in IMPORT_FIELDS)
+        record['text'] = (values.get('text') or '').decode('utf-8')
+        record['state'] = record['state'] or STATES[0]
+        if record['state'] not in STATES:
+            raise TracError('Line %d: unknown state "%s"' % (line, record['state']))
+        try:
+            record['priority'] = record['priority'] and int(record['priority']) or None
+        except ValueError:
+            raise TracError('Line %d: the priority must be a number' % line)
+        record['tags'] = _split_tags(record['tags'])
+        if record['name']:
+            if record['name'] in names:
+                raise TracError('Line %d: page %s is listed twice' % (line, record['name']))
+            names.add(record['name'])
+        records.append(record)
+    return records
+
+def _split_tags(value):
+    """Split a comma or whitespace separated list of tags."""
+    return [t for t in re.split(r'[,\s]+', value or '') if t]
+
+def _select_in(cursor, sql, names, batch_size=500):
+    """Return the rows of `sql`, whose `IN (%s)` list is filled with `names`,
+    queried in batches that stay below SQLite's limit of bind variables."""
+    rows = []
+    for start in range(0, len(names), batch_size):
+        batch = list(names[start:start + batch_size])
+        cursor.execute(sql % ','.join(['%s'] * len(batch)), batch)
+        rows.extend(cursor.fetchall())
+    return rows
+
+def _write_meta_rows(cursor, rows):
+    """Make `(name, owner, state, priority, time, author)` rows the current
+    meta data of their pages, with one batched statement per step."""
+    record_meta_rows(cursor, rows)
+    names = [(row[0],) for row in rows]
+    cursor.executemany("""
+            UPDATE wikimeta set current=0 where name=%s and current=1
+        """, names)
+    cursor.executemany("""
+            INSERT into wikimeta (name, owner, state, priority, time, author, current)
+            values (%s, %s, %s, %s, %s, %s, 1)
+        """, rows)
+    cursor.executemany("""
+            DELETE FROM wikimeta_current where name=%s
+        """, names)
+    cursor.executemany("""
+            INSERT into wikimeta_current (name, owner, state, priority, time, author)
+            values (%s, %s, %s, %s, %s, %s)
+        """, rows)
+
+
+
+# One page of the WikiFilter view, as passed to the template.
+WikiRow = namedtuple('WikiRow', ['name', 'owner', 'state', 'priority', 'time', 'author',
+                                 'html', 'tags', 'last_modified', 'raisable', 'lowerable'])
+
+
+class PageMeta(object):
+    __slots__ = ('name', 'owner', 'state', 'priority', 'time', 'author')
 
-
-class PageMeta:
     def __init__(self, name, owner, state, priority, time, author):
         self.name = name
         self.owner = owner
@@ -72,73 +296,44 @@ class PageMeta:
         self.priority = priority
         self.time = time
         self.author = author
-        self.items = {}
-
-    def __getitem__(self, key):
-        if key in self.items:
-            return self.items[key]
-        return None
-
-    def __setitem__(self, key, value):
-        self.items[key] = value
-
-    def __getitems__(self):
-        self.items['name'] = self.name
-        self.items['owner'] = self.owner
-        self.items['state'] = self.state
-        self.items['priority'] = self.priority
-        self.items['time'] = self.time
-        self.items['author'] = self.author
-        return self.items.copy()
 
     def _get_tags(self, env):
         tags = []
-        db = env.get_db_cnx()
+        db = get_db(env)
         cursor = db.cursor()
         cursor.execute("""
             SELECT tag FROM tags where tagspace='wiki' and name=%s group by tag
-        """, (self.name))
+        """, (self.name,))
         for row in cursor:
             tags.append(row[0])
         return tags
 
     def save(self, env, old_meta):
-        env.log.debug(' +++ save: %s' % self.name)
+        env.log.debug(' +++ save: %s', self.name)
         if old_meta is not None:
             self.priority = old_meta.priority
             if self.owner == old_meta.owner and self.state == old_meta.state:
-                env.log.debug(' +++ existing meta equals old meta: %s, %s' % (old_meta.owner, old_meta.state))
+                env.log.debug(' +++ existing meta equals old meta: %s, %s', old_meta.owner, old_meta.state)
                 return False
         else:
-            env.log.debug(' +++ no existing meta, saving: %s' % self.name)
+            env.log.debug(' +++ no existing meta, saving: %s', self.name)
         self.insert(env)
         return True
 
     def insert(self, env):
         """insert the wiki meta data in the database."""
         #env.log.debug(' +++ in insert')
-        db = env.get_db_cnx()
-        cursor = db.cursor()
-        cursor.execute("""
-                UPDATE wikimeta set current=0 where name=%s 
-            """, (self.name))
-        if self.state == 'planned':
-            if self.priority == 0:
-                cursor.execute("""
-                    INSERT into wikimeta (name, owner, state, priority, time, author, current)
-                    select %s, %s, %s, ifnull(max(priority) + 1,1), %s, %s, 1 from wikimeta where current=1
-                """, (self.name, self.owner, self.state, time.time(), self.author))
-            else:
-                cursor.execute("""
-                    INSERT into wikimeta (name, owner, state, priority, time, author, current)
-                    values (%s, %s, %s, %s, %s, %s, 1) 
-                """, (self.name, self.owner, self.state, self.priority, time.time(), self.author))
-        else:
-            cursor.execute("""
-                INSERT into wikimeta (name, owner, state, priority, time, author, current)
-                values (%s, %s, %s, %s, %s, %s, 1) 
-            """, (self.name, self.owner, self.state, 0, time.time(), self.author))
-        db.commit()
+        with transaction(env) as db:
+            cursor = db.cursor()
+            priority = 0
+            if self.state == 'planned':
+                priority = self.priority
+                if priority == 0:
+                    cursor.execute(NEXT_PRIORITY_SQL)
+                    priority = int(cursor.fetchone()[0])
+            _write_meta_rows(cursor, [(self.name, self.owner, self.state, priority,
+                                        time.time(), self.author)])
+            WikiMetaPlugin(env)._page_meta_changed(self.name)
         #env.log.debug(' +++ done saving state: %s' % self.state)
 
 class WikiMetaPlugin(Component):
@@ -147,20 +342,107 @@ class WikiMetaPlugin(Component):
         IWikiPageManipulator, IWikiChangeListener, IRequestFilter, 
         IPermissionRequestor, IPermissionPolicy)
 
+    render_cache_size = IntOption('wikimeta', 'render_cache_size', 500,
+        """Maximum number of rendered page versions kept in memory for the
+        WikiFilter view, per user and base URL they were rendered for (0
+        disables the cache).""")
+
+    page_size = IntOption('wikimeta', 'page_size', 50,
+        """Number of pages shown per page of the WikiFilter view.""")
+
+    render_workers = IntOption('wikimeta', 'render_workers', 0,
+        """Number of threads formatting the pages of a WikiFilter view
+        concurrently (0 or 1 formats them one after another).""")
+
+    profile_requests = BoolOption('wikimeta', 'profile_requests', 'false',
+        """Count the SQL statements and time the rendering, tag and sidebar
+        work of WikiMeta and wiki edit requests, report them in a
+        `Server-Timing` response header and collect them for the WikiMeta
+        profiling admin panel.""")
+
+    sidebar_cache_ttl = IntOption('wikimeta', 'sidebar_cache_ttl', 300,
+        """Seconds for which the tag categories and known users of the filter
+        sidebar, and the tags of the pages, are cached. Tag changes made
+        through this plugin refresh the caches at once; the timeout covers
+        changes made elsewhere.""")
+
+    warm_filters = IntOption('wikimeta', 'warm_filters', 0,
+        """Number of the most requested filter combinations whose sidebar,
+        tag and facet caches a background thread fills again after startup
+        and after each change, so that their next request finds them filled
+        (0 disables the warmer). The first page of each is rendered for the
+        users and base URLs that requested it most.""")
+
+    def __init__(self):
+        # bumped whenever tags, tag categories, the page order or page
+        # versions change in ways no newer timestamp records:
+        self._generation = 0
+        # bumped whenever the metadata or tags of any page change:
+        self._meta_generation = 0
+        # the last seen value of the generation shared by all processes,
+        # kept in the system table:
+        self._shared_generation = None
+        # (generation, expiry time, categorized tags, known user index):
+        self._sidebar_meta = None
+        # rendered HTML, keyed by (page name, page version, user, href base):
+        self._render_cache = LRUCache(self.render_cache_size)
+        # started on first use when render_workers > 1:
+        self._render_pool = None
+        # tag -> current pages, loaded on first use:
+        self._tag_index = TagIndex()
+        # option counts, keyed by (meta generation, filter combination):
+        self._facet_cache = LRUCache(FACET_CACHE_SIZE)
+        # WikiMeta macro results, keyed by (meta generation, query, limit):
+        self._macro_cache = LRUCache(MACRO_CACHE_SIZE)
+        # timings of the last profiled requests:
+        self._request_stats = RollingStats()
+        # requests per (state, owner, tags, text) filter, for the warmer:
+        self._filter_hits = HitCounter()
+        # requests per (filter combination, user, base URL), as rendered HTML
+        # is cached per user and base URL:
+        self._render_hits = HitCounter()
+        # set when the caches need warming, started on first use:
+        self._warm_event = threading.Event()
+        self._warm_event.set()
+        self._warm_thread = None
+        self._warm_lock = threading.Lock()
+
     # IRequestFilter methods
     def pre_process_request(self, req, handler):
-        self.log.debug(" +++ in pre_process_request")
-        self.log.debug(dir(req.args))
-        self.log.debug(req.args)
+        # requests ended by RequestDone (sent JSON, exports, redirects, 304s)
+        # skip post_process_request; drop the timings they left on the thread
+        end()
+        if self.profile_requests and self._is_profiled(req):
+            begin()
+        if self.warm_filters > 0 and self._warm_thread is None:
+            self._start_warmer()
+        self.log.debug(" +++ in pre_process_request: %r", req.args)
         if req and req.path_info.startswith('/wiki') and 'save' in req.args and 'state_name' in req.args and 'page' in req.args:
             page_meta = PageMeta(req.args.get('page'), req.args.get('owner_name'), req.args.get('state_name'), 0, time.time(), get_reporter_id(req, 'author'))
-            if page_meta.save(self.env, self._get_page_meta(req.args.get('page'))):
-                req.args.__setitem__('wikimeta', 'updated')
+            # the lookup, the new rows and the shared generation commit once
+            with transaction(self.env):
+                if page_meta.save(self.env, self._get_page_meta(req.args.get('page'))):
+                    req.args.__setitem__('wikimeta', 'updated')
         #self.log.debug(" +++ in pre_process_request, done")
         return handler
 
+    def _is_profiled(self, req):
+        """Return whether `req` is a request this plugin does work in: a
+        WikiMeta request or the edit or save of a wiki page."""
+        path = req.path_info
+        if path == '/wikimeta' or path.startswith('/wikimeta/'):
+            return True
+        return path.startswith('/wiki') and (req.args.get('action') == 'edit'
+                                             or 'save' in req.args)
+
     def post_process_request(self, req, template, data, content_type):
         self.log.debug(" +++ in post_process_request")
+        timings = end()
+        if timings is not None and timings.durations:
+            req.send_header('Server-Timing', timings.server_timing())
+            self._request_stats.record(timings)
+        if template == 'wiki_edit.html':
+            add_script(req, 'wm/js/wikimeta.js')
         return (template, data, content_type)
 
     # ITemplateStreamFilter methods
@@ -168,8 +450,8 @@ class WikiMetaPlugin(Component):
         #self.log.debug(" +++ in modified filter_stream")
         if filename == 'wiki_edit.html':
             return self._wiki_edit(req, req.path_info, stream)
-        else:
-            return stream | Transformer('//img').attr('alt', 'NOT wiki edit')
+        # all other templates pass through untouched
+        return stream
 
 
     # internal (for now)
@@ -186,42 +468,41 @@ class WikiMetaPlugin(Component):
         if page_meta is not None and len(page_meta.owner) > 0:
             owner = page_meta.owner
             state = page_meta.state
-        user_tuples = self.env.get_known_users()
-        user_ids = [item[0] for item in user_tuples]
         select_state = _create_select('state', 'state_id', 'state_name', STATES, state, 'planned')
-        select_owner = _create_select('owner', 'owner_id', 'owner_name', user_ids, owner, 'dybuster')
-        return stream | Transformer('//div[@id="changeinfo1"]').prepend(select_owner).prepend(select_state)
+        select_owner = _create_select('owner', 'owner_id', 'owner_name', [], owner, 'dybuster',
+                                      autocomplete_url=req.href.wikimeta('users'))
+        return Stream(_prepend_to_id(stream, 'changeinfo1', tag(select_state, select_owner)),
+                      stream.serializer)
 
     def _get_page_meta(self, name):
         """Return meta information for a wiki page."""
-        self.log.debug(" +++ in _get_page_meta for %s" % name)
-        db = self.env.get_db_cnx()
+        self.log.debug(" +++ in _get_page_meta for %s", name)
+        db = get_db(self.env)
         cursor = db.cursor()
         cursor.execute("""
-            SELECT owner, state, priority, time, author FROM wikimeta WHERE name=%s and current=1
-        """, (name))
+            SELECT owner, state, priority, time, author FROM wikimeta_current WHERE name=%s
+        """, (name,))
         for row in cursor:
-            self.log.debug(" +++ in _get_page_meta, found row with state %s" % row[1])
+            self.log.debug(" +++ in _get_page_meta, found row with state %s", row[1])
             return PageMeta(name, row[0], row[1], int(row[2]), int(row[3]), row[4])
-        self.log.debug(" +++ in _get_page_meta, no row for %s" % name)
+        self.log.debug(" +++ in _get_page_meta, no row for %s", name)
         return None
 
     def _get_categorized_tags(self):
         tags = {}
-        db = self.env.get_db_cnx()
+        db = get_db(self.env)
         cursor = db.cursor()
         cursor.execute("""
             SELECT tag, category FROM tags_category order by tag
         """)
         for row in cursor:
-            if row[1] in tags.keys():
-                tags[row[1]].append(row[0])
-            else:
-                tags[row[1]] = [ row[0] ]
+            tags.setdefault(row[1], []).append(row[0])
         # now get the uncategorized:
         uncategorized = []
         cursor.execute("""
-            select tag from tags where tag not in (select tag from tags_category) group by tag
+            SELECT t.tag FROM tags t
+              LEFT OUTER JOIN tags_category c ON c.tag=t.tag
+             WHERE c.tag IS NULL group by t.tag
         """)
         for row in cursor:
             uncategorized.append(row[0])
@@ -229,13 +510,29 @@ class WikiMetaPlugin(Component):
             tags['uncategorized'] = uncategorized
         return tags
 
+    def _get_sidebar_meta(self):
+        """Return the categorized tags of the filter sidebar and a prefix
+        index of the known user ids, cached until tags change or
+        sidebar_cache_ttl expires."""
+        now = time.time()
+        cached = self._sidebar_meta
+        if cached is not None and cached[0] == self._generation and now < cached[1]:
+            return cached[2], cached[3]
+        generation = self._generation
+        with timer('sidebar'):
+            categorized_tags = self._get_categorized_tags()
+            user_index = PrefixIndex([item[0] for item in self.env.get_known_users()])
+        self._sidebar_meta = (generation, now + self.sidebar_cache_ttl,
+                              categorized_tags, user_index)
+        return categorized_tags, user_index
+
     # IPermissionRequestor method
     def get_permission_actions(self):
         return ['WIKIMETA_VIEW']
 
     # IPermissionPolicy method
     def check_permission(self, action, username, resource, perm):
-        self.log.debug(" +++ check_permission, action: %s" % action)
+        self.log.debug(" +++ check_permission, action: %s", action)
         return True
 
 
@@ -261,30 +558,64 @@ class WikiMetaPlugin(Component):
     # IWikiChangeListener methods
     def wiki_page_added(self, page):
         self.log.debug(" +++ in wiki_page_added")
+        with transaction(self.env):
+            self._index_page(page.name, page.text)
+            self._tags_changed(page.name)
+        # links to the new page render differently on other pages
+        self._render_cache.clear()
 
     def wiki_page_changed(self, page, version, t, comment, author, ipnr):
         self.log.debug(" +++ in wiki_page_changed")
+        with transaction(self.env):
+            self._index_page(page.name, page.text)
+            # the page's tags may have been edited together with its text
+            self._tags_changed(page.name)
+        self._render_cache.invalidate(page.name)
 
     def wiki_page_renamed(self, page, old_name):
         self.log.debug(" +++ in wiki_page_renamed")
-        db = self.env.get_db_cnx()
-        cursor = db.cursor()
-        cursor.execute("""
-                UPDATE wikimeta set name=%s where name=%s
-                """, (page.name, old_name))
-        db.commit()
+        with transaction(self.env) as db:
+            cursor = db.cursor()
+            cursor.execute("""
+                    UPDATE wikimeta set name=%s where name=%s
+                    """, (page.name, old_name))
+            cursor.execute("""
+                    UPDATE wikimeta_current set name=%s where name=%s
+                    """, (page.name, old_name))
+            cursor.execute("""
+                    UPDATE wikimeta_archive set name=%s where name=%s
+                    """, (page.name, old_name))
+            rename_page(cursor, old_name, page.name)
+            self._tags_changed(old_name, page.name)
+        self._render_cache.clear()
 
     def wiki_page_deleted(self, page):
         self.log.debug(" +++ in wiki_page_deleted")
-        db = self.env.get_db_cnx()
-        cursor = db.cursor()
-        cursor.execute("""
-                UPDATE wikimeta set current=0 where name=%s
-                """, (page.name))
-        db.commit()
+        with transaction(self.env) as db:
+            cursor = db.cursor()
+            record_deletions(cursor, [page.name], time.time())
+            cursor.execute("""
+                    UPDATE wikimeta set current=0 where name=%s and current=1
+                    """, (page.name,))
+            cursor.execute("""
+                    DELETE FROM wikimeta_current where name=%s
+                    """, (page.name,))
+            remove_page(cursor, page.name)
+            self._tags_changed(page.name)
+        self._render_cache.clear()
 
     def wiki_page_version_deleted(self, page):
         self.log.debug(" +++ in wiki_page_version_deleted")
+        with transaction(self.env):
+            # the text is now the one of the newest remaining version
+            self._index_page(page.name, WikiPage(self.env, page.name).text)
+            self._bump_generation()
+        self._render_cache.invalidate(page.name)
+
+    def _index_page(self, name, text):
+        with transaction(self.env) as db:
+            with timer('index'):
+                index_page(db.cursor(), name, text)
 
     # INavigationContributor methods
     def get_active_navigation_item(self, req):
@@ -301,35 +632,48 @@ class WikiMetaPlugin(Component):
     
     def process_request(self, req):
         req.perm.require('WIKIMETA_VIEW')
+        # the caches are only read below, so only these requests check them
+        self._sync_generation()
         
         data = {}
-        self.log.debug(" +++ in process_request")
-        self.log.debug(dir(req.args))
-        self.log.debug(req.args)
-        # first process reordering:
-        for key in req.args.keys():
-            if key.startswith('reorder_'):
-                self.log.debug(" +++ found reorder: %s" % key)
-                reorder_args = key.split('_')
-                self._priority_reorder(int(reorder_args[1]), int(reorder_args[2]))
+        self.log.debug(" +++ in process_request: %r", req.args)
+        if req.path_info == '/wikimeta/reorder':
+            return self._process_reorder(req)
+        if req.path_info == '/wikimeta/bulk':
+            return self._process_bulk(req)
+        if req.path_info == '/wikimeta/import':
+            return self._process_import(req)
+        if req.path_info == '/wikimeta/users':
+            return self._process_users(req)
+        if req.method in ('GET', 'HEAD') and not req.args.get('newpagename') \
+                and 'move_up' not in req.args and 'move_down' not in req.args:
+            self._check_modified(req)
+        if req.path_info == '/wikimeta/report':
+            return self._process_report(req)
+
+        export_format = req.args.get('format')
+        if export_format in EXPORT_FORMATS:
+            return self._process_export(req, export_format)
 
         # data for state filter
         data['state_label'] = 'State:'
-        data['state_options'] = ['all (non-obsolete)'] + STATES
-        data['selected_state'] = 'all (non-obsolete)'
+        data['state_options'] = [ALL_STATES] + STATES
+        data['selected_state'] = ALL_STATES
         if req.args.get('state_name') is not None:
             data['selected_state'] = req.args.get('state_name')
         # data for owner filter
         data['owner_label'] = 'Owner:'
-        owner_tuples = self.env.get_known_users()
-        data['owner_options'] = ['all'] + [item[0] for item in owner_tuples]
-        data['selected_owner'] = 'all'
-        if req.args.get('owner_name') is not None:
+        categorized_tags = self._get_sidebar_meta()[0]
+        data['users_href'] = req.href.wikimeta('users')
+        data['selected_owner'] = ALL_OWNERS
+        if req.args.get('owner_name'):
             data['selected_owner'] = req.args.get('owner_name')
+        # data for the text filter
+        data['text_label'] = 'Text:'
+        data['text'] = req.args.get('q', '')
 
         # data for tag filters
         combined_title = ""
-        categorized_tags = self._get_categorized_tags()
         tag_states = []
         tag_list = []
 
@@ -349,12 +693,25 @@ class WikiMetaPlugin(Component):
         else:
             data['combined_title'] = combined_title
 
+        # process reordering, relative to the neighbour in the filtered view,
+        # looking up the neighbour and moving the page in one transaction:
+        for direction in ('up', 'down'):
+            moved_name = req.args.get('move_%s' % direction)
+            if moved_name:
+                self.log.debug(" +++ found move %s: %s", direction, moved_name)
+                query = MetaQuery(data['selected_state'], data['selected_owner'], tag_list,
+                                  data['text'])
+                with transaction(self.env) as db:
+                    neighbour = query.neighbour(db, moved_name, direction == 'up')
+                    if neighbour is not None:
+                        self._priority_reorder(moved_name, neighbour, direction == 'up')
+
         # check if the user requested to add a new page:
         newpagename = req.args.get('newpagename')
         if newpagename is not None and len(newpagename) > 0:
             newpage = WikiPage(self.env, newpagename)
             currently_logged_in_user = get_reporter_id(req, 'author')
-            if data['selected_owner'] == 'all':
+            if data['selected_owner'] == ALL_OWNERS:
                 new_owner = currently_logged_in_user
             else:
                 new_owner = data['selected_owner']
@@ -362,118 +719,808 @@ class WikiMetaPlugin(Component):
                 newpage.text = 'page content goes here'
                 newpage.save(author=currently_logged_in_user, comment='', remote_addr='127.0.0.1')
             # add tags and meta
-            if data['selected_state'] == 'all (non-obsolete)':
+            if data['selected_state'] == ALL_STATES:
                 new_state = 'planned'
             else:
                 new_state = data['selected_state']
             new_page_meta = PageMeta(newpagename, new_owner, new_state, 0, time.time(), currently_logged_in_user)
-            new_page_meta.insert(self.env)
-            tag_resource(self.env, newpage.resource, old_id=None, author=currently_logged_in_user, tags=tag_list)
+            with transaction(self.env) as db:
+                new_page_meta.insert(self.env)
+                # tags are written directly, like in _bulk_update, as the
+                # tagging API commits a connection of its own
+                cursor = db.cursor()
+                old_tags = set(new_page_meta._get_tags(self.env))
+                added = set(tag_list) - old_tags
+                removed = old_tags - set(tag_list)
+                record_tag_changes(cursor, new_page_meta.time,
+                                   [(newpagename, added, removed)])
+                cursor.executemany("""
+                        DELETE FROM tags where tagspace='wiki' and name=%s and tag=%s
+                        """, [(newpagename, t) for t in removed])
+                cursor.executemany("""
+                        INSERT into tags (tagspace, name, tag) values ('wiki', %s, %s)
+                        """, [(newpagename, t) for t in added])
+                self._tags_changed(newpagename)
 
         # get a top context to render the wiki data:
         context = Context.from_request(req, 'wiki')
-        self.log.debug(" +++ context: ")
-        self.log.debug(dir(context))
-        self.log.debug(" +++ child: ")
-        self.log.debug(context.child)
-        self.log.debug(" +++ href: ")
-        self.log.debug(context.href)
-        self.log.debug(" +++ parent: ")
-        self.log.debug(context.parent)
-
-        # get the wiki pages:
-        wiki_data = self._get_wiki_data(context, data['selected_state'], data['selected_owner'], tag_list)
+        self.log.debug(" +++ context: %r", context)
+
+        # get one page of the wiki pages, starting after the keyset cursor:
+        page_cursor = req.args.get('after') or req.args.get('cursor')
+        after = parse_cursor(page_cursor)
+        data['cursor'] = after and page_cursor or ''
+        filter_args = dict([('tagfilter_%s' % tag, 'on') for tag in tag_list])
+        data['first_page_href'] = req.href.wikimeta(state_name=data['selected_state'],
+                owner_name=data['selected_owner'], q=data['text'] or None, **filter_args)
+        data['back_href'] = req.href.wikimeta()
+        if data['selected_owner'] != ALL_OWNERS:
+            data['report_href'] = req.href.wikimeta('report', kind='owner',
+                                                    value=data['selected_owner'])
+        elif len(tag_list) == 1:
+            data['report_href'] = req.href.wikimeta('report', kind='tag', value=tag_list[0])
+        else:
+            data['report_href'] = req.href.wikimeta('report')
+        if req.query_string:
+            data['back_href'] += '?' + req.query_string
+        filter_key = (data['selected_state'], data['selected_owner'],
+                      tuple(sorted(tag_list)), data['text'])
+        self._filter_hits.hit(filter_key)
+        self._render_hits.hit((filter_key, req.authname, req.href.base))
+        # result counts of the filter options, for the current selection:
+        data['state_counts'], owner_counts, data['tag_counts'] = self._get_facets(
+                MetaQuery(data['selected_state'], data['selected_owner'], tag_list,
+                          data['text']))
+        data['owner_counts'] = sorted(owner_counts.items(),
+                                      key=lambda item: (-item[1], item[0]))
+        wiki_data, data['next_cursor'] = self._get_wiki_data(context, data['selected_state'],
+                data['selected_owner'], tag_list, after, self.page_size, data['text'])
         #self.log.debug(" +++ wiki_data:")
         #self.log.debug(wiki_data)
         data['wiki_data'] = wiki_data
 
         add_stylesheet(req, 'wm/css/wikimeta.css')
+        add_script(req, 'wm/js/wikimeta.js')
         # This tuple is for Genshi (template_name, data, content_type)
         # Without data the trac layout will not appear.
         return 'wikimeta.html', data, None
 
+    def _check_modified(self, req):
+        """Send the validators of the filtered view, and answer a matching
+        `If-None-Match` or `If-Modified-Since` with 304 Not Modified before
+        anything is queried or rendered.
+
+        The validators are built from the database only, so that all
+        processes send the same ones for the same data."""
+        db = get_db(self.env)
+        cursor = db.cursor()
+        cursor.execute("SELECT max(time) FROM wikimeta_current")
+        meta_time = float(cursor.fetchone()[0] or 0)
+        cursor.execute("SELECT max(time) FROM wiki")
+        wiki_time = (cursor.fetchone()[0] or 0) / 1000000.0  # microseconds
+        cursor.execute("""
+            SELECT name, value FROM system
+             WHERE name IN ('wikimeta_generation', 'wikimeta_generation_time')
+            """)
+        shared = dict(cursor.fetchall())
+        generation_time = float(shared.get('wikimeta_generation_time') or 0)
+        # tags written through the TracTags API bump no generation
+        tags = sha1()
+        cursor.execute("""
+            SELECT name, tag FROM tags WHERE tagspace='wiki' ORDER BY name, tag
+            """)
+        for row in cursor:
+            tags.update(repr(row))
+        last_modified = int(max(meta_time, wiki_time, generation_time))
+        etag = 'W/"%s"' % sha1(repr((meta_time, wiki_time,
+                                     shared.get('wikimeta_generation'),
+                                     generation_time, tags.hexdigest(),
+                                     req.authname, req.query_string))).hexdigest()
+        inm = req.get_header('If-None-Match')
+        ims = req.get_header('If-Modified-Since')
+        not_modified = False
+        if inm is not None:
+            not_modified = etag in [value.strip() for value in inm.split(',')]
+        elif ims is not None:
+            since = parsedate_tz(ims)
+            not_modified = since is not None and last_modified <= mktime_tz(since)
+        if not_modified:
+            req.send_response(304)
+            req.send_header('ETag', etag)
+            req.end_headers()
+            raise RequestDone
+        req.send_header('ETag', etag)
+        req.send_header('Last-Modified', http_date(last_modified))
+
     # find a good name that could be used for a new wiki page:
     def _get_unused_title(self, tag_list):
-        db = self.env.get_db_cnx()
-        cursor = db.cursor()
+        return self._get_unused_titles(self._title_base(tag_list))[0]
+
+    def _title_base(self, tag_list):
         if len(tag_list) == 0:
-            base = 'Misc'
-        else:
-            base = ''
-            for tag in tag_list:
-                base = '%s%s' % (base, tag.capitalize())
-        for index in range(1,5000):
+            return 'Misc'
+        base = ''
+        for tag in tag_list:
+            base = '%s%s' % (base, tag.capitalize())
+        return base
+
+    def _get_unused_titles(self, base, count=1, exclude=()):
+        """Return the `count` lowest names `<base><number>` that no wiki
+        page uses and that are not in `exclude`, from a single query for the
+        names starting with `base`."""
+        db = get_db(self.env)
+        cursor = db.cursor()
+        cursor.execute("""
+            SELECT DISTINCT name FROM wiki WHERE name %s
+            """ % db.like(), (db.like_escape(base) + '%',))
+        used = set(row[0] for row in cursor) | set(exclude)
+        names = []
+        index = 1
+        while len(names) < count:
             name = '%s%d' % (base, index)
+            if name not in used:
+                names.append(name)
+            index += 1
+        return names
+
+    def _import_pages(self, records, author):
+        """Create or update the pages of import records, see
+        `_read_import_csv`, in one transaction per IMPORT_BATCH_SIZE records.
+        Returns the numbers of imported and of newly created pages.
+
+        New pages are written to the wiki table directly, with the text of
+        the record; the text of existing pages is left alone. Meta data and
+        tags are set like by a bulk update.
+        """
+        if not records:
+            return 0, 0
+        unnamed = {}
+        for record in records:
+            if not record['name']:
+                unnamed.setdefault(self._title_base(record['tags']), []).append(record)
+        listed = set(record['name'] for record in records)
+        for base, group in unnamed.items():
+            for record, name in zip(group, self._get_unused_titles(base, len(group), listed)):
+                record['name'] = name
+        now = time.time()
+        wiki_time = to_utimestamp(to_datetime(now, utc))
+        db = get_db(self.env)
+        cursor = db.cursor()
+        cursor.execute(NEXT_PRIORITY_SQL)
+        next_priority = int(cursor.fetchone()[0])
+        created = 0
+        for start in range(0, len(records), IMPORT_BATCH_SIZE):
+            batch = records[start:start + IMPORT_BATCH_SIZE]
+            names = [record['name'] for record in batch]
+            in_names = ','.join(['%s'] * len(names))
             cursor.execute("""
-                SELECT * 
-                FROM wiki WHERE name=%s 
-            """, (name))
-            row = cursor.fetchone()
-            if not row:
-                return name
-
-    # Fetch all page data, depending on the filters:
-    def _get_wiki_data(self, context, selected_state, selected_owner, tag_list):
-        """Get all page data for pages matching criteria."""
-        #self.log.debug(" +++ in _get_wiki_data")
-        page_metas = []
-        page_datas = {}
-        returnList = []
-        db = self.env.get_db_cnx()
+                    SELECT DISTINCT name FROM wiki WHERE name IN (%s)
+                    """ % in_names, names)
+            existing = set(row[0] for row in cursor)
+            new_pages = [(record['name'], record['text'] or 'page content goes here')
+                         for record in batch if record['name'] not in existing]
+            cursor.executemany("""
+                    INSERT INTO wiki (name, version, time, author, ipnr, text, comment, readonly)
+                    VALUES (%s, 1, %s, %s, '127.0.0.1', %s, 'imported', 0)
+                    """, [(name, wiki_time, author, text) for name, text in new_pages])
+            for name, text in new_pages:
+                index_page(cursor, name, text)
+
+            # tags are written directly, like in _bulk_update, and before the meta
+            # rows, so that new pages are counted under them in the rollups
+            cursor.execute("""
+                    SELECT name, tag FROM tags where tagspace='wiki' and name IN (%s)
+                    """ % in_names, names)
+            existing_tags = set((row[0], row[1]) for row in cursor)
+            record_tag_changes(cursor, now, [
+                    (record['name'], set(t for t in record['tags']
+                                         if (record['name'], t) not in existing_tags), ())
+                    for record in batch])
+            cursor.executemany("""
+                    INSERT into tags (tagspace, name, tag) values ('wiki', %s, %s)
+                    """, list(set((record['name'], t) for record in batch
+                                   for t in record['tags']
+                                   if (record['name'], t) not in existing_tags)))
+
+            cursor.execute("""
+                    SELECT name, state, priority FROM wikimeta_current
+                    where name IN (%s)
+                    """ % in_names, names)
+            current = dict((row[0], row) for row in cursor)
+            rows = []
+            for record in batch:
+                priority = 0
+                if record['state'] == 'planned':
+                    old = current.get(record['name'])
+                    if record['priority'] is not None:
+                        priority = record['priority']
+                    elif old is not None and old[1] == 'planned':
+                        priority = int(old[2])
+                    else:
+                        priority = next_priority
+                        next_priority += PRIORITY_GAP
+                rows.append((record['name'], record['owner'] or author, record['state'],
+                             priority, now, author))
+            _write_meta_rows(cursor, rows)
+            db.commit()
+            created += len(new_pages)
+        # the rows above bypass WikiPage, which would reset the page names
+        # cached by the wiki system
+        try:
+            del WikiSystem(self.env).pages
+        except AttributeError:
+            pass
+        # links to the new pages render differently on other pages
+        self._render_cache.clear()
+        self._tags_changed(*[record['name'] for record in records])
+        return len(records), created
+
+    # Fetch one page of page data, depending on the filters:
+    def _get_wiki_data(self, context, selected_state, selected_owner, tag_list, after=None, limit=None,
+                       text=None):
+        """Get the data for pages matching criteria.
+
+        At most `limit` pages sorting after the `after` cursor are returned as
+        a generator of `WikiRow`s, together with the cursor of the following
+        page (None on the last page). The pages are rendered before this
+        returns; the rows are built while the template iterates over them.
+        """
+        db = get_db(self.env)
+        query = MetaQuery(selected_state, selected_owner, tag_list, text)
+        rows = query.execute(db, after=after, limit=limit and limit + 1)
+        next_row = None
+        next_cursor = None
+        if limit and len(rows) > limit:
+            next_row = rows[limit]
+            rows = rows[:limit]
+            next_cursor = format_cursor(rows[-1])
+        tag_index = self._get_tag_index()
+        pages = [WikiPage(self.env, row[0]) for row in rows]
+        # meta rows of pages that no longer exist are left out
+        rows = [row for row, page in zip(rows, pages) if page.exists]
+        pages = [page for page in pages if page.exists]
+        htmls = self._render_pages(context, pages)
+        # only planned pages can be moved; the neighbours across the page
+        # boundaries are the row of the cursor and the extra row fetched
+        # beyond the limit:
+        movable = selected_state == 'planned'
+        last = len(rows) - 1
+
+        def generate():
+            for index, (row, page, html) in enumerate(zip(rows, pages, htmls)):
+                yield WikiRow(row[0], row[1], row[2], int(row[3]), int(row[4]), row[5],
+                              html, tag_index.tags_of(row[0]),
+                              page.time.strftime("%Y.%m.%d"),
+                              movable and (index > 0 or after is not None),
+                              movable and (index < last or next_row is not None))
+        return generate(), next_cursor
+
+    def _get_tag_index(self):
+        """Return the tag index, bringing it up to date first. Like the
+        sidebar, it is reloaded after sidebar_cache_ttl."""
+        with timer('tags'):
+            self._tag_index.sync(get_db(self.env), self.sidebar_cache_ttl)
+        return self._tag_index
+
+    def _page_meta_changed(self, *names):
+        """Called after the wikimeta rows of pages have been written. The
+        caches of this process are updated once the writes are committed."""
+        def changed():
+            for name in names:
+                self._tag_index.invalidate(name)
+            self._meta_generation += 1
+            self._warm_event.set()
+        self._publish_generation()
+        after_commit(self.env, changed)
+
+    def _tags_changed(self, *names):
+        """Called after the tags of pages, or the tag categories if no names
+        are given, have been written."""
+        def changed():
+            for name in names:
+                self._tag_index.invalidate(name)
+        after_commit(self.env, changed)
+        self._bump_generation()
+
+    def _bump_generation(self):
+        def changed():
+            self._generation += 1
+            self._meta_generation += 1
+            self._warm_event.set()
+        self._publish_generation()
+        after_commit(self.env, changed)
+
+    def _publish_generation(self):
+        """Increment the shared generation in the system table, so that the
+        other processes drop their caches before their next request."""
+        db = get_db(self.env)
         cursor = db.cursor()
+        while True:
+            cursor.execute("""
+                SELECT value FROM system WHERE name='wikimeta_generation'
+                """)
+            row = cursor.fetchone()
+            if row is None:
+                value = '1'
+                cursor.execute("""
+                    INSERT INTO system (name, value)
+                    VALUES ('wikimeta_generation', %s)
+                    """, (value,))
+                break
+            value = str(int(row[0]) + 1)
+            cursor.execute("""
+                UPDATE system SET value=%s
+                WHERE name='wikimeta_generation' AND value=%s
+                """, (value, row[0]))
+            if cursor.rowcount == 1:
+                break
+        # when it changed, for the Last-Modified header of all processes
+        cursor.execute("""
+            UPDATE system SET value=%s WHERE name='wikimeta_generation_time'
+            """, (str(time.time()),))
+        if cursor.rowcount == 0:
+            cursor.execute("""
+                INSERT INTO system (name, value)
+                VALUES ('wikimeta_generation_time', %s)
+                """, (str(time.time()),))
+        db.commit()
+        if row is not None and row[0] != self._shared_generation:
+            # another process changed something since our last check
+            self._clear_caches()
+        self._shared_generation = value
+
+    def _sync_generation(self):
+        """Drop the in-process caches if another process has changed the
+        wikimeta data since this process last looked. Called where the
+        caches are read, not on every request."""
+        cursor = get_db(self.env).cursor()
         cursor.execute("""
-                SELECT name, owner, state, priority, time, author 
-                FROM wikimeta WHERE current=1 
-                order by priority desc, time desc
+            SELECT value FROM system WHERE name='wikimeta_generation'
             """)
-        for row in cursor:
-            #self.log.debug(" +++ in _get_page_meta, found row with state %s" % row[2])
-            if selected_owner == 'all' or selected_owner == row[1]:
-                if selected_state == row[2] or (selected_state == 'all (non-obsolete)' and 'obsolete' != row[2]):
-                    page_metas.append(PageMeta(row[0], row[1], row[2], int(row[3]), int(row[4]), row[5]))
-        for page_meta in page_metas:
-            page_tags = page_meta._get_tags(self.env)
-            if set(tag_list).issubset(page_tags):
-                # passes all tests, so get the data:
-                page = WikiPage(self.env, page_meta.name)
-                if page is not None:
-                    page_data = page_meta.__getitems__()
-                    page_data['html'] = Markup(HtmlFormatter(self.env, context('wiki', page_meta.name), page.text).generate())
-                    page_data['tags'] = page_tags
-                    page_data['last_modified'] = page.time.strftime("%Y.%m.%d")
-                    returnList.append(page_data)
-        if len(returnList) > 1 and selected_state == 'planned':
-            for index in range(0,len(returnList)):
-                if index > 0:
-                    returnList[index]['raisable'] = 'True'
-                    returnList[index]['prev_priority'] = returnList[index - 1]['priority']
-                if index < len(returnList) - 1:
-                    returnList[index]['lowerable'] = 'True'
-                    returnList[index]['next_priority'] = returnList[index + 1]['priority']
-        return returnList
-
-    def _priority_reorder(self, initial_priority, change_to_priority):
-        db = self.env.get_db_cnx()
-        cursor = db.cursor()
+        row = cursor.fetchone()
+        value = row and row[0]
+        if value != self._shared_generation:
+            self._clear_caches()
+            self._shared_generation = value
+
+    def _clear_caches(self):
+        # rendered HTML is keyed by page version, but its links and embedded
+        # WikiMeta macros change with pages added, renamed or deleted in
+        # another process, which the local change listeners never see
+        self._render_cache.clear()
+        self._tag_index.clear()
+        self._sidebar_meta = None
+        self._generation += 1
+        self._meta_generation += 1
+        self._warm_event.set()
+
+    def _start_warmer(self):
+        self._warm_lock.acquire()
+        try:
+            if self._warm_thread is not None:
+                return
+            self._load_filter_hits()
+            self._warm_thread = threading.Thread(target=self._warm_loop,
+                                                 name='wikimeta-warmer')
+            self._warm_thread.setDaemon(True)
+            self._warm_thread.start()
+        finally:
+            self._warm_lock.release()
+
+    def _warm_loop(self):
+        while True:
+            self._warm_event.wait()
+            time.sleep(WARM_DELAY)
+            self._warm_event.clear()
+            try:
+                self._warm_caches()
+            except Exception:
+                self.log.warning("wikimeta: warming the caches failed",
+                                 exc_info=True)
+
+    def _warm_caches(self):
+        """Fill the sidebar, tag and facet caches for the most requested
+        filter combinations, and render their first page for the users and
+        base URLs that requested them most, as their requests would."""
+        self._sync_generation()
+        filters = self._filter_hits.most_common(self.warm_filters)
+        renders = self._render_hits.most_common(self.warm_filters)
+        self._get_sidebar_meta()
+        self._get_tag_index()
+        for (state, owner, tag_list, text), count in filters:
+            self._get_facets(MetaQuery(state, owner, tag_list, text))
+        for ((state, owner, tag_list, text), authname, base), count in renders:
+            context = Context(Resource('wiki'), href=Href(base),
+                              perm=PermissionCache(self.env, authname))
+            self._get_wiki_data(context, state, owner, list(tag_list), None,
+                                self.page_size, text)
+        self._save_hits('wikimeta_warm_filters', filters)
+        self._save_hits('wikimeta_warm_renders', renders)
+
+    def _load_filter_hits(self):
+        """Seed the request counts with the filters warmed by the last
+        process, so that they are warmed at startup."""
+        for (state, owner, tag_list, text), count in self._load_hits('wikimeta_warm_filters'):
+            self._filter_hits.hit((state, owner, tuple(tag_list), text), count)
+        for ((state, owner, tag_list, text), authname, base), count in \
+                self._load_hits('wikimeta_warm_renders'):
+            self._render_hits.hit(((state, owner, tuple(tag_list), text), authname, base),
+                                  count)
+
+    def _load_hits(self, name):
+        cursor = get_db(self.env).cursor()
         cursor.execute("""
-                UPDATE wikimeta set priority=-2 where priority=%s
-                """, (initial_priority))
+            SELECT value FROM system WHERE name=%s
+            """, (name,))
+        row = cursor.fetchone()
+        if row is None:
+            return []
+        return json.loads(row[0])
 
-        if initial_priority > change_to_priority:
+    def _save_hits(self, name, hits):
+        value = json.dumps(hits)
+        db = get_db(self.env)
+        cursor = db.cursor()
+        cursor.execute("""
+            UPDATE system SET value=%s WHERE name=%s
+            """, (value, name))
+        if cursor.rowcount == 0:
             cursor.execute("""
-                UPDATE wikimeta set priority=(priority + 1) where priority<=%s and priority>=%s
-                """, (initial_priority, change_to_priority))
-        else:
+                INSERT INTO system (name, value) VALUES (%s, %s)
+                """, (name, value))
+        db.commit()
+
+    def _get_facets(self, query):
+        """Return the `(states, owners, tags)` option counts of a query,
+        cached per filter combination until page metadata or tags change."""
+        key = (self._meta_generation, query.state, query.owner,
+               tuple(sorted(query.tags)), tuple(query.words))
+        facets = self._facet_cache.get(key)
+        if facets is None:
+            with timer('facets'):
+                facets = query.facets(get_db(self.env))
+            self._facet_cache.set(key, facets)
+        return facets
+
+    def _get_macro_rows(self, query, limit):
+        """Return the first `limit + 1` rows of a query for the WikiMeta
+        macro, cached per query until page metadata or tags change."""
+        key = (self._meta_generation, query.state, query.owner,
+               tuple(sorted(query.tags)), tuple(query.words), limit)
+        rows = self._macro_cache.get(key)
+        if rows is None:
+            with timer('macro'):
+                rows = query.execute(get_db(self.env), limit=limit + 1)
+            self._macro_cache.set(key, rows)
+        return rows
+
+    def _render_key(self, context, page):
+        """Return the render cache key of a page in `context`.
+
+        The HTML depends on who it is rendered for (macros and links respect
+        the permissions) and on the base of the links, so both are part of
+        the key."""
+        return (page.name, page.version, context.perm.username, context.href.base)
+
+    def _render_page(self, context, page):
+        """Return the rendered HTML of a wiki page, cached per version and
+        rendering identity."""
+        key = self._render_key(context, page)
+        html = self._render_cache.get(key)
+        if html is None:
+            with timer('render'):
+                html = Markup(HtmlFormatter(self.env, context('wiki', page.name), page.text).generate())
+            self._render_cache.set(key, html)
+        return html
+
+    def _render_pages(self, context, pages):
+        """Return the rendered HTML of `pages`, in the same order.
+
+        With `render_workers` > 1, the pages missing from the render cache
+        are formatted concurrently by a shared thread pool.
+        """
+        htmls = [None] * len(pages)
+        misses = [index for index, page in enumerate(pages)
+                  if self._render_cache.get(self._render_key(context, page)) is None]
+        if self.render_workers > 1 and len(misses) > 1:
+            with timer('render'):
+                rendered = self._get_render_pool().map(
+                    lambda index: self._render_page(context, pages[index]), misses)
+            # merged by index, as the cache may be too small to hold them
+            for index, html in zip(misses, rendered):
+                htmls[index] = html
+        for index, page in enumerate(pages):
+            if htmls[index] is None:
+                htmls[index] = self._render_page(context, page)
+        return htmls
+
+    def _get_render_pool(self):
+        if self._render_pool is None:
+            self._render_pool = ThreadPool(self.render_workers)
+        return self._render_pool
+
+    def _priority_reorder(self, name, neighbour, above=True):
+        """Move page `name` just above (or below) page `neighbour`.
+
+        Only the priority of `name` changes, unless there is no rank left
+        between the neighbours; then the planned pages are renumbered first.
+        """
+        with transaction(self.env) as db:
+            cursor = db.cursor()
+            for attempt in range(2):
+                cursor.execute("""
+                        SELECT priority FROM wikimeta_current where name=%s
+                        """, (neighbour,))
+                row = cursor.fetchone()
+                if row is None:
+                    return
+                pivot = int(row[0])
+                if above:
+                    cursor.execute("""
+                            SELECT min(priority) FROM wikimeta_current
+                            where priority>%s and name<>%s
+                            """, (pivot, name))
+                    bound = cursor.fetchone()[0]
+                    if bound is None:
+                        bound = pivot + 2 * PRIORITY_GAP
+                else:
+                    cursor.execute("""
+                            SELECT max(priority) FROM wikimeta_current
+                            where priority<%s and name<>%s
+                            """, (pivot, name))
+                    bound = max(cursor.fetchone()[0] or 0, 0)
+                priority = (pivot + int(bound)) // 2
+                if min(pivot, bound) < priority < max(pivot, bound):
+                    break
+                self._rebalance_priorities(cursor)
             cursor.execute("""
-                UPDATE wikimeta set priority=(priority - 1) where priority<=%s and priority>=%s
-                """, (change_to_priority, initial_priority))
+                    UPDATE wikimeta_current set priority=%s where name=%s
+                    """, (priority, name))
+            self._bump_generation()
 
+    def _rebalance_priorities(self, cursor):
+        """Spread the ranks of the planned pages PRIORITY_GAP apart."""
+        self.log.info("rebalancing wikimeta priorities")
         cursor.execute("""
-                UPDATE wikimeta set priority=%s where priority=-2
-                """, (change_to_priority))
-
-        db.commit()
-
+                SELECT name FROM wikimeta_current where priority>0
+                order by priority desc, time desc, name
+                """)
+        names = [row[0] for row in cursor]
+        cursor.executemany("""
+                UPDATE wikimeta_current set priority=%s where name=%s
+                """, [((len(names) - index) * PRIORITY_GAP, name)
+                      for index, name in enumerate(names)])
+
+    def _apply_ordering(self, names):
+        """Give the planned pages in `names` their own ranks in the given
+        order, highest first, in one transaction.
+
+        Pages not listed keep their position relative to each other.
+        Returns a list of `(name, priority)` tuples.
+        """
+        with transaction(self.env) as db:
+            cursor = db.cursor()
+            sql = """
+                    SELECT name, priority FROM wikimeta_current
+                    where state='planned' and name IN (%s)
+                    """
+            priorities = dict((row[0], int(row[1]))
+                              for row in _select_in(cursor, sql, names))
+            if len(set(priorities.values())) < len(priorities):
+                # ties from older rankings, spread them first
+                self._rebalance_priorities(cursor)
+                priorities = dict((row[0], int(row[1]))
+                                  for row in _select_in(cursor, sql, names))
+            names = [name for name in names if name in priorities]
+            ranks = sorted(priorities.values(), reverse=True)
+            ordering = zip(names, ranks)
+            cursor.executemany("""
+                    UPDATE wikimeta_current set priority=%s where name=%s
+                    """, [(priority, name) for name, priority in ordering])
+            self._bump_generation()
+        return ordering
+
+    def _process_reorder(self, req):
+        """Handle `POST /wikimeta/reorder` with the new order of pages given
+        as repeated `page` arguments, highest priority first."""
+        if req.method != 'POST':
+            raise TracError('Reordering requires a POST request')
+        names = req.args.get('page', [])
+        if not isinstance(names, list):
+            names = [names]
+        ordering = []
+        if names:
+            ordering = self._apply_ordering(names)
+        req.send(json.dumps({'pages': [{'name': name, 'priority': priority}
+                                       for name, priority in ordering]}),
+                 'application/json')
+
+    def _process_export(self, req, export_format):
+        """Stream the metadata of all pages matching the filter arguments as
+        JSON or CSV. Rows are read from the cursor in batches, and no page
+        text is read or rendered."""
+        state = req.args.get('state_name') or ALL_STATES
+        owner = req.args.get('owner_name') or ALL_OWNERS
+        tag_list = [key[len('tagfilter_'):] for key in req.args.keys()
+                    if key.startswith('tagfilter_')]
+        query = MetaQuery(state, owner, tag_list, req.args.get('q'))
+        tag_index = self._get_tag_index()
+
+        def records():
+            for row in query.iterate(get_db(self.env)):
+                last_modified = None
+                if row[6] is not None:
+                    last_modified = from_utimestamp(row[6]).strftime('%Y-%m-%dT%H:%M:%SZ')
+                yield {'name': row[0], 'owner': row[1], 'state': row[2],
+                       'priority': int(row[3]),
+                       'time': to_datetime(float(row[4]), utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                       'author': row[5], 'tags': tag_index.tags_of(row[0]),
+                       'last_modified': last_modified}
+
+        if export_format == 'json':
+            chunks = _export_json(records())
+        else:
+            chunks = _export_csv(records())
+        req.send_response(200)
+        req.send_header('Content-Type', '%s; charset=utf-8' % EXPORT_FORMATS[export_format])
+        if export_format == 'csv':
+            req.send_header('Content-Disposition', 'attachment; filename=wikimeta.csv')
+        req.end_headers()
+        if req.method != 'HEAD':
+            for chunk in chunks:
+                req.write(chunk)
+        raise RequestDone
+
+    def _process_report(self, req):
+        """Show the state transitions and the open pages per period, for all
+        pages or the pages of one owner or tag, from the daily rollups."""
+        kind = req.args.get('kind')
+        if kind not in REPORT_KINDS:
+            kind = 'all'
+        value = kind != 'all' and req.args.get('value') or ''
+        period = req.args.get('period')
+        if period not in REPORT_PERIODS:
+            period = 'week'
+        with timer('report'):
+            pairs, periods = summarize(get_db(self.env), kind, value, period)
+        data = {'kinds': REPORT_KINDS, 'kind': kind, 'value': value,
+                'periods': REPORT_PERIODS, 'period': period,
+                'users_href': req.href.wikimeta('users'),
+                'pairs': pairs, 'rows': periods,
+                'max_open': max([row[2] for row in periods] + [1])}
+        add_stylesheet(req, 'wm/css/wikimeta.css')
+        add_script(req, 'wm/js/wikimeta.js')
+        return 'wikimeta_report.html', data, None
+
+    def _process_users(self, req):
+        """Handle `GET /wikimeta/users?q=prefix`: return the known user ids
+        starting with the prefix as a JSON list."""
+        try:
+            limit = min(int(req.args.get('limit', 20)), 100)
+        except ValueError:
+            limit = 20
+        user_index = self._get_sidebar_meta()[1]
+        req.send(json.dumps(user_index.complete(req.args.get('q', ''), limit)),
+                 'application/json')
+
+    def _bulk_update(self, names, owner, state, add_tags, remove_tags, author):
+        """Set owner and/or state and add or remove tags for many pages, with
+        batched statements in a single transaction.
+
+        `owner` and `state` are left unchanged when empty, and names of pages
+        that do not exist are skipped. Returns the number of pages whose meta
+        data changed.
+        """
+        with transaction(self.env) as db:
+            cursor = db.cursor()
+            # meta data and tags are only written for existing pages
+            existing_pages = set(row[0] for row in _select_in(cursor, """
+                    SELECT DISTINCT name FROM wiki WHERE name IN (%s)
+                    """, names))
+            names = [name for name in names if name in existing_pages]
+            current = dict((row[0], row) for row in _select_in(cursor, """
+                    SELECT name, owner, state, priority FROM wikimeta_current
+                    where name IN (%s)
+                    """, names))
+            cursor.execute(NEXT_PRIORITY_SQL)
+            next_priority = int(cursor.fetchone()[0])
+            now = time.time()
+            rows = []
+            for name in names:
+                old = current.get(name)
+                new_owner = owner or (old and old[1]) or author
+                new_state = state or (old and old[2]) or STATES[0]
+                if old is not None and (new_owner, new_state) == (old[1], old[2]):
+                    continue
+                priority = 0
+                if new_state == 'planned':
+                    if old is not None and old[2] == 'planned':
+                        priority = int(old[3])
+                    else:
+                        priority = next_priority
+                        next_priority += PRIORITY_GAP
+                rows.append((name, new_owner, new_state, priority, now, author))
+            if rows:
+                _write_meta_rows(cursor, rows)
+
+            # tags are written directly, like they are read in the tag index
+            if add_tags or remove_tags:
+                existing = set((row[0], row[1]) for row in _select_in(cursor, """
+                        SELECT name, tag FROM tags where tagspace='wiki' and name IN (%s)
+                        """, names))
+                record_tag_changes(cursor, now, [
+                        (name,
+                         [t for t in add_tags if (name, t) not in existing and t not in remove_tags],
+                         [t for t in remove_tags if (name, t) in existing])
+                        for name in names])
+                cursor.executemany("""
+                        DELETE FROM tags where tagspace='wiki' and name=%s and tag=%s
+                        """, [(name, t) for name in names for t in remove_tags
+                              if (name, t) in existing])
+                cursor.executemany("""
+                        INSERT into tags (tagspace, name, tag) values ('wiki', %s, %s)
+                        """, [(name, t) for name in names for t in add_tags
+                              if (name, t) not in existing and t not in remove_tags])
+            if add_tags or remove_tags:
+                self._tags_changed(*names)
+            else:
+                self._page_meta_changed(*names)
+        return len(rows)
+
+    def _process_bulk(self, req):
+        """Handle `POST /wikimeta/bulk`: apply the owner, state and tag
+        changes to the selected pages and return to the filtered view."""
+        if req.method != 'POST':
+            raise TracError('Bulk updates require a POST request')
+        names = req.args.get('page', [])
+        if not isinstance(names, list):
+            names = [names]
+        state = req.args.get('bulk_state')
+        if state and state not in STATES:
+            raise TracError('Unknown state "%s"' % state)
+        req.perm.require('WIKI_MODIFY')
+        add_tags = _split_tags(req.args.get('bulk_add_tags'))
+        remove_tags = _split_tags(req.args.get('bulk_remove_tags'))
+        if add_tags or remove_tags:
+            req.perm.require('TAGS_MODIFY')
+        if names:
+            changed = self._bulk_update(names, req.args.get('bulk_owner'), state,
+                                        add_tags, remove_tags,
+                                        get_reporter_id(req, 'author'))
+            self.log.info("bulk update of %d pages by %s, %d meta changes"
+                          % (len(names), req.authname, changed))
+        back = req.args.get('back')
+        if not back or not back.startswith(req.href.wikimeta()):
+            back = req.href.wikimeta()
+        req.redirect(back)
+
+    def _process_import(self, req):
+        """Handle `POST /wikimeta/import`: create or update the pages listed
+        in an uploaded CSV file and return to the filtered view."""
+        req.perm.require('WIKI_CREATE')
+        if req.method != 'POST':
+            raise TracError('Imports require a POST request')
+        upload = req.args.get('csvfile')
+        if not hasattr(upload, 'file'):
+            raise TracError('No CSV file was uploaded')
+        records = _read_import_csv(upload.file)
+        existing = set(row[0] for row in _select_in(get_db(self.env).cursor(), """
+                SELECT DISTINCT name FROM wiki WHERE name IN (%s)
+                """, [record['name'] for record in records if record['name']]))
+        if existing:
+            # the meta data and tags of existing pages are overwritten, which
+            # needs the permissions of a bulk update
+            req.perm.require('WIKI_MODIFY')
+            if [record for record in records
+                    if record['name'] in existing and record['tags']]:
+                req.perm.require('TAGS_MODIFY')
+        imported, created = self._import_pages(records, get_reporter_id(req, 'author'))
+        self.log.info("import of %d pages by %s, %d created"
+                      % (imported, req.authname, created))
+        back = req.args.get('back')
+        if not back or not back.startswith(req.href.wikimeta()):
+            back = req.href.wikimeta()
+        req.redirect(back)
 
     # ITemplateProvider methods
     # Used to add the plugin's templates and htdocs 
@@ -506,13 +1553,10 @@ class WikiMetaPlugin(Component):
         pluginName = 'wikimeta_version'
 
         self.log.debug(" +++ in environment_needs_upgrade")
-        self.log.debug(" +++ dbm: ")
-        self.log.debug(dir(dbm))
 
         schema_ver = self.get_schema_version(db=db, pluginName=pluginName)
 
-        self.log.debug(" +++ schema_ver: ")
-        self.log.debug(schema_ver)
+        self.log.debug(" +++ schema_ver: %s", schema_ver)
 
         tags_version = self.get_schema_version(db=db, pluginName='tags_version')
         if tags_version == 0:
@@ -529,18 +1573,29 @@ class WikiMetaPlugin(Component):
         pluginName = 'wikimeta_version'
         schema_ver = self.get_schema_version(db=db, pluginName=pluginName)
 
+        cursor = db.cursor()
         if schema_ver == 0:
             dbm.create_tables(PLUGIN_SCHEMA)
 
-            cursor = db.cursor()
-
             cursor.execute("""
                 INSERT into system (name, value)
                    values (%s,%s)
                 """, (pluginName, PLUGIN_DB_VERSION))
-            self.log.info("initialized wikimeta db schema: %d to %d"
+            reindex_all(cursor)
+            rebuild_rollups(cursor, HISTORY_SQL)
+        else:
+            # run the scripts in wikimeta/upgrades for each missing version
+            for version in range(schema_ver + 1, PLUGIN_DB_VERSION + 1):
+                name = 'db%i' % version
+                upgrades = __import__('upgrades', globals(), locals(), [name])
+                script = getattr(upgrades, name)
+                script.do_upgrade(self.env, version, cursor)
+            cursor.execute("""
+                UPDATE system set value=%s where name=%s
+                """, (PLUGIN_DB_VERSION, pluginName))
+        self.log.info("upgraded wikimeta db schema: %d to %d"
                       % (schema_ver, PLUGIN_DB_VERSION))
-            db.commit()
+        db.commit()
 
     # upgrade-related methods copied from tags plugin:
     def get_schema_version(self, db=None, pluginName='wikimeta_version'):
@@ -552,7 +1607,7 @@ class WikiMetaPlugin(Component):
             SELECT value
               FROM system
              WHERE name=%s
-        """, pluginName)
+        """, (pluginName,))
         row = cursor.fetchone()
         if not row:
             return 0
@@ -581,3 +1636,63 @@ class WikiMetaPlugin(Component):
         cursor.execute(sql)
         return sorted([row[0] for row in cursor])
 
+
+class WikiMetaMacro(WikiMacroBase):
+    """Insert a list of the pages matching a WikiFilter query.
+
+    Takes the filters of the WikiFilter view as keyword arguments:
+     * `state`: a state, or `all` for all but obsolete pages (the default)
+     * `owner`: the owner of the pages
+     * `tag`: the tags the pages must all have, separated by spaces
+     * `text`: words the pages must contain
+     * `limit`: the number of pages shown, 10 by default
+     * `format`: `list` (the default) or `table`, which also shows the
+       owner, state and tags of each page
+
+    Example:
+    {{{
+    [[WikiMeta(state=planned, owner=joe, tag=release1 docs, limit=5)]]
+    }}}
+    """
+
+    def expand_macro(self, formatter, name, content):
+        if 'WIKIMETA_VIEW' not in formatter.perm:
+            return ''
+        args, kw = parse_args(content or '')
+        state = kw.get('state') or ALL_STATES
+        if state == 'all':
+            state = ALL_STATES
+        owner = kw.get('owner') or ALL_OWNERS
+        tag_list = _split_tags(kw.get('tag'))
+        try:
+            limit = max(int(kw.get('limit') or 10), 1)
+        except ValueError:
+            return system_message('WikiMeta: limit must be a number, not "%s"'
+                                  % kw.get('limit'))
+        plugin = WikiMetaPlugin(self.env)
+        plugin._sync_generation()
+        query = MetaQuery(state, owner, tag_list, kw.get('text'))
+        rows = plugin._get_macro_rows(query, limit)
+        href = formatter.href
+        more = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            filter_args = dict([('tagfilter_%s' % value, 'on') for value in tag_list])
+            more = tag.a('more...', href=href.wikimeta(state_name=state, owner_name=owner,
+                                                       q=kw.get('text'), **filter_args))
+        if kw.get('format') == 'table':
+            tag_index = plugin._get_tag_index()
+            return tag.table(
+                tag.thead(tag.tr(tag.th('Page'), tag.th('Owner'), tag.th('State'),
+                                 tag.th('Tags'))),
+                tag.tbody([tag.tr(tag.td(tag.a(row[0], href=href.wiki(row[0]))),
+                                  tag.td(row[1]), tag.td(row[2]),
+                                  tag.td(' '.join(tag_index.tags_of(row[0]))))
+                           for row in rows],
+                          more and tag.tr(tag.td(more, colspan='4')) or None),
+                class_='listing wikimeta')
+        return tag.ul([tag.li(tag.a(row[0], href=href.wiki(row[0])),
+                              ' (%s, %s)' % (row[1], row[2]))
+                       for row in rows],
+                      more and tag.li(more) or None,
+                      class_='wikimeta')